@@ -0,0 +1,170 @@
+"""Benchmarks of the data processing paths.
+
+Run with: python benchmark.py [rows] [columns]
+"""
+
+from typing import Dict
+import pandas
+import numpy
+import convert
+import table
+import time
+import sys
+import re
+
+
+def synthetic_raw(rows: int, columns: int, seed: int = 0) -> pandas.DataFrame:
+    """Create a raw Ankieter-like DataFrame, where every question is saved
+    in a few repeated columns, most of them containing defaults.
+
+    :param rows: Number of rows
+    :type rows: int
+    :param columns: Number of columns
+    :type columns: int
+    :param seed: Seed of the random generator (default: 0)
+    :type seed: int
+    :return: The data
+    :rtype: pandas.DataFrame
+    """
+
+    rng = numpy.random.default_rng(seed)
+    data = {}
+    question = 0
+    while len(data) < columns:
+        repeats = int(rng.integers(1, 6))
+        answers = rng.integers(1, 6, size=rows)
+        chosen = rng.integers(0, repeats, size=rows)
+        for r in range(min(repeats, columns - len(data))):
+            name = f'Question {question}' if r == 0 else f'Question {question}.{r}'
+            data[name] = numpy.where(chosen == r, answers, 9999)
+        question += 1
+    return pandas.DataFrame(data)
+
+
+def merge_by_rows(df: pandas.DataFrame, defaults: Dict) -> pandas.DataFrame:
+    """Join repeated columns with a row aggregator, the way raw_to_compact
+    did before the merging was vectorized.
+
+    :param df: The raw data
+    :type df: pandas.DataFrame
+    :param defaults: A dict with default values set for each column name
+    :type defaults: Dict
+    :return: The joined data
+    :rtype: pandas.DataFrame
+    """
+
+    repeats = df.filter(regex=r'\.\d+$').columns.values
+    uniques = [c for c in df.columns.values if c not in repeats]
+    for u in uniques:
+        group = list(df.filter(regex=re.escape(u)+r'\.\d+$').columns.values)
+        group.append(u)
+        df[u] = df[group].aggregate(convert.nodefaults(defaults, u), axis='columns')
+        df = df.drop(group[:-1], axis='columns')
+    return df
+
+
+def reorder_by_values(data: pandas.DataFrame) -> Dict:
+    """Serialize a table converting its values one by one, the way reorder
+    did before the conversions were vectorized.
+
+    :param data: Aggregated data
+    :type data: pandas.DataFrame
+    :return: The table
+    :rtype: Dict
+    """
+
+    data = data.apply(lambda s: pandas.Series(table.tobasetypes_of(s), index=s.index, dtype=object))
+    data.columns = [f'{label}' for label, aggr in data.columns]
+    result = {}
+    result['index'] = list(map(lambda x: x if x is not True else '*', data.index.tolist()))
+    for column in data:
+        result[column] = data[column].tolist()
+    return result
+
+
+def measure(f, *args):
+    """Call a function and return its result and the time it took"""
+
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_merge(rows: int, columns: int):
+    """Compare joining repeated columns by rows and with vectorized merges,
+    both with and without default values known.
+    """
+
+    df = synthetic_raw(rows, columns)
+    with_defaults = {c: {'9999'} for c in df.columns.values}
+    for name, defaults in (('nodefaults', with_defaults), ('antimode', {})):
+        old, old_time = measure(merge_by_rows, df.copy(), defaults)
+        new, new_time = measure(convert.raw_to_compact, None, df.copy(), defaults)
+        pandas.testing.assert_frame_equal(old, new)
+        print(f'merge {name:10} {rows}x{columns}: rows {old_time:8.3f}s, vectorized {new_time:8.3f}s')
+
+
+def bench_reorder(rows: int, columns: int):
+    """Compare converting values of aggregated tables one by one and with
+    vectorized conversions.
+    """
+
+    rng = numpy.random.default_rng(0)
+    data = {}
+    for i in range(columns):
+        values = rng.integers(0, 100, size=rows).astype(float)
+        if i % 3 == 1:
+            values = values / 7
+        if i % 3 == 2:
+            values = [{int(v): 1} for v in values]
+        data[(f'aggr {i}', 'aggr')] = values
+    data = pandas.DataFrame(data)
+    old, old_time = measure(reorder_by_values, data)
+    new, new_time = measure(table.reorder, data)
+    assert repr(old) == repr(new)
+    print(f'reorder {rows}x{columns}: by values {old_time:8.3f}s, vectorized {new_time:8.3f}s')
+
+
+def bench_share(rows: int, columns: int):
+    """Compare computing share and mode of Likert-scale answers for every
+    group separately and for all groups at once.
+    """
+
+    rng = numpy.random.default_rng(0)
+    data = {'group g': pandas.Series(rng.integers(0, max(rows // 50, 1), size=rows), dtype='Int64')}
+    aggregators = {}
+    for i in range(columns):
+        answers = pandas.Series(rng.integers(1, 6, size=rows), dtype='Int64')
+        data[f'share {i}'] = answers
+        data[f'mode {i}'] = answers
+        aggregators[f'share {i}'] = [table.share]
+        aggregators[f'mode {i}'] = [table.mode]
+    data = pandas.DataFrame(data)
+    old, old_time = measure(lambda: data.groupby('group g').aggregate(aggregators))
+    new, new_time = measure(lambda: table.aggregate_groups(data.groupby('group g'), data, aggregators))
+    assert repr(table.reorder(old)) == repr(table.reorder(new))
+    print(f'share/mode {rows}x{columns}: by groups {old_time:8.3f}s, all groups {new_time:8.3f}s')
+
+
+def bench_join(rows: int, columns: int):
+    """Join all columns into one, the way multiple answer questions are"""
+
+    df = synthetic_raw(rows, columns).convert_dtypes()
+    df['Group'] = pandas.Series(numpy.arange(rows) % 10, dtype='Int64')
+    query = {
+        'get': [['Joined']],
+        'as': ['share'],
+        'by': ['Group'],
+        'join': [{'name': 'Joined', 'of': [c for c in df.columns if c != 'Group']}],
+    }
+    _, join_time = measure(table.columns, query, None, None, df)
+    print(f'join {rows}x{columns}: {join_time:8.3f}s')
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    columns = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    bench_merge(rows, columns)
+    bench_reorder(rows, columns)
+    bench_share(rows, columns)
+    bench_join(rows, columns)
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+import threading
+
+
+class LRU:
+    """A thread-safe cache that evicts the least recently used entries when
+    there are too many of them, or when they get too big in total.
+    """
+
+    def __init__(self, entries: int, size: int = 0, sizeof: Callable[[Any], int] = lambda value: 0):
+        """Create an empty cache.
+
+        :param entries: Maximal number of entries (0 disables the cache)
+        :type entries: int
+        :param size: Maximal total size of entries (0 for no limit)
+        :type size: int
+        :param sizeof: A function estimating the size of a value
+        :type sizeof: Callable[[Any], int]
+        """
+
+        self.entries = entries
+        self.size = size
+        self.sizeof = sizeof
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value and mark it as the most recently used one.
+
+        :param key: The key of the value
+        :type key: Hashable
+        :param default: Returned if there is no such key (default: None)
+        :return: The cached value or the default
+        """
+
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key][0]
+
+    def put(self, key: Hashable, value: Any):
+        """Save a value, evicting old ones if needed.
+
+        :param key: The key of the value
+        :type key: Hashable
+        :param value: The value
+        """
+
+        size = self.sizeof(value)
+        with self.lock:
+            if self.entries <= 0 or (self.size and size > self.size):
+                return
+            if key in self.data:
+                self.used -= self.data.pop(key)[1]
+            self.data[key] = (value, size)
+            self.used += size
+            while len(self.data) > self.entries or (self.size and self.used > self.size):
+                _, (_, evicted) = self.data.popitem(last=False)
+                self.used -= evicted
+
+    def invalidate(self, match: Callable[[Hashable], bool] = lambda key: True):
+        """Remove entries whose keys match the predicate, all by default.
+
+        :param match: A predicate on keys
+        :type match: Callable[[Hashable], bool]
+        """
+
+        with self.lock:
+            for key in [k for k in self.data if match(k)]:
+                self.used -= self.data.pop(key)[1]
+
+    def stats(self) -> dict:
+        """Get usage statistics of the cache.
+
+        :return: Numbers of entries, hits and misses, and the total size
+        :rtype: dict
+        """
+
+        with self.lock:
+            return {
+                'entries': len(self.data),
+                'size':    self.used,
+                'hits':    self.hits,
+                'misses':  self.misses,
+            }
@@ -1,13 +1,22 @@
-from typing import Dict, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from globals import CSV_CHUNK_ROWS
+from pandas.io.parsers import TextParser
 from pathlib import Path
-import xml.etree.ElementTree as ET
 import database
+import definitions
+import store
+import pool
 import sqlite3
 import pandas
+import numpy
 import error
 import json
+import itertools
+import datetime
+import openpyxl
 import csv
 import re
+import os
 
 def antimode(vals: pandas.Series):
     """Return one of the rarest of the values in a series.
@@ -59,6 +68,56 @@ def nodefaults(defaults: Dict, name: str):
     return f
 
 
+def merge_columns(df: pandas.DataFrame, group: List[str], defaults: Dict, name: str) -> pandas.Series:
+    """Join a group of columns into one. The values are chosen exactly like
+    a nodefaults aggregator would choose them, but for all rows at once.
+
+    :param df: DataFrame containing the columns
+    :type df: pandas.DataFrame
+    :param group: Names of the columns, in the order they are aggregated
+    :type group: List[str]
+    :param defaults: Default column values as returned from get_default_values
+    :type defaults: Dict
+    :param name: A name of the group of columns
+    :type name: str
+    :return: The joined column, columns of objects are joined into a column
+        of objects, which can be inferred to a better type
+    :rtype: pandas.Series
+    """
+
+    if len(group) == 1:
+        return df[group[0]]
+
+    # Rows are aggregated as arrays of the common type of the columns
+    values = df[group].to_numpy()
+
+    # Objects are counted by identity in antimode (NaNs from the same column
+    # are the same object), leave them to the row aggregator
+    if values.dtype.kind not in 'biuf':
+        f = nodefaults(defaults, name)
+        result = numpy.empty(len(values), dtype=object)
+        for i, row in enumerate(values):
+            result[i] = f(row)
+        return pandas.Series(result, index=df.index)
+
+    if name in defaults:
+        # Compare the values with defaults as strings, like the aggregator,
+        # and choose the first non-default or the first value
+        found = [v for v in pandas.unique(values.ravel()) if str(v) in defaults[name]]
+        default = pandas.Series(values.ravel()).isin(found).to_numpy().reshape(values.shape)
+        chosen = numpy.argmax(~default, axis=1)
+    else:
+        # Choose the first of the rarest values, every NaN is unique
+        counts = numpy.zeros(values.shape, dtype='int64')
+        if values.dtype.kind == 'f':
+            counts += numpy.isnan(values)
+        for j in range(values.shape[1]):
+            counts[:, j] += (values == values[:, [j]]).sum(axis=1)
+        chosen = numpy.argmin(counts, axis=1)
+
+    return pandas.Series(values[numpy.arange(len(values)), chosen], index=df.index)
+
+
 def get_default_values(survey: database.Survey) -> Dict:
     """Get default value string for every question in the survey database
 
@@ -68,19 +127,22 @@ def get_default_values(survey: database.Survey) -> Dict:
     :rtype: Dict
     """
 
-    xml = ET.parse(f"survey/{survey.id}.xml")
-    questions = ["groupedsingle","single","multi"]
+    def read(xml):
+        questions = ["groupedsingle","single","multi"]
+
+        result = {}
+        for b in xml.getroot().iter("questions"):
+            for e in list(b):
+                if e.tag in questions:
+                    header = re.sub('</?\w[^>]*>', '', e.find("header").text).strip(' \n')
+                    if header not in result:
+                        result[header] = {'9999'}
+                    if 'defaultValue' in e.attrib:
+                        result[header].add(str(e.attrib['defaultValue']))
+        return result
 
-    result = {}
-    for b in xml.getroot().iter("questions"):
-        for e in list(b):
-            if e.tag in questions:
-                header = re.sub('</?\w[^>]*>', '', e.find("header").text).strip(' \n')
-                if header not in result:
-                    result[header] = {'9999'}
-                if 'defaultValue' in e.attrib:
-                    result[header].add(str(e.attrib['defaultValue']))
-    return result
+    defaults = definitions.load(survey.id).get('defaults', read)
+    return {k: set(v) for k, v in defaults.items()}
 
 
 # DEBUG: this function is too strict for practical use or it has a bug
@@ -129,6 +191,89 @@ def detect_csv_sep(filename: str) -> str:
     return sep
 
 
+def compact_plan(columns: List[str], defaults: Dict = {}) -> Tuple[Dict[str, List[str]], Dict[str, List[int]]]:
+    """Plan the conversion of raw Ankieter columns into compact ones. The
+    plan depends only on the names of the columns, so it can be used for
+    every part of the data.
+
+    :param columns: Names of the raw columns
+    :type columns: List[str]
+    :param defaults: A dict with default values set for each column name
+    :type defaults: Dict
+    :return: A dict from names of compact columns to the raw columns they
+        are joined from, and a dict from names of compact columns to values
+        that have to be replaced by 9999
+    :rtype: Tuple[Dict[str, List[str]], Dict[str, List[int]]]
+    """
+
+    # remove XML tags in question names
+    names = {c: re.sub('</?\w[^>]*>', '', c) for c in columns}
+
+    # remove all "czas wypełniania" columns
+    names = {c: n for c, n in names.items() if not re.search("czas wypełniania", n)}
+
+    # Get all columns with \.\d+ suffixes, this is how Pandas marks repeated
+    # column names, along with the names without the suffixes
+    repeats = {}
+    for c, n in names.items():
+        suffix = re.search(r'\.\d+$', n)
+        if suffix:
+            repeats[c] = n[:suffix.start()]
+
+    # Now join repeated columns into one named by their base names, a column
+    # belongs to the first base name its name without the suffix ends with
+    groups = {}
+    joined = set()
+    for c, n in names.items():
+        if c not in repeats:
+            groups[c] = [r for r, base in repeats.items() if r not in joined and base.endswith(n)]
+            joined.update(groups[c])
+    groups = {names[c]: groups.get(c, []) + [c] for c in names if c not in joined}
+
+    # Convert all remaining defaults to the standard 9999
+    replacements = {}
+    for k, v in defaults.items():
+        for n in groups:
+            if re.search(k, n):
+                replacements.setdefault(n, []).extend(int(x) for x in v)
+
+    return groups, replacements
+
+
+def compact(df: pandas.DataFrame, plan: Tuple[Dict[str, List[str]], Dict[str, List[int]]], defaults: Dict = {}, infer: bool = True) -> pandas.DataFrame:
+    """Convert a raw Ankieter DataFrame according to a plan.
+
+    :param df: DataFrame containing the raw data
+    :type df: pandas.DataFrame
+    :param plan: The plan, as returned from compact_plan
+    :type plan: Tuple[Dict[str, List[str]], Dict[str, List[int]]]
+    :param defaults: A dict with default values set for each column name
+    :type defaults: Dict
+    :param infer: Whether to infer types of joined columns of objects, which
+        only a whole file should be done with (default: True)
+    :type infer: bool
+    :return: The compacted data
+    :rtype: pandas.DataFrame
+    """
+
+    groups, replacements = plan
+    columns = {}
+    for n, group in groups.items():
+        columns[n] = merge_columns(df, group, defaults, n)
+        if infer and len(group) > 1:
+            columns[n] = columns[n].infer_objects()
+    df = pandas.DataFrame(columns, index=df.index)
+    for n, v in replacements.items():
+        if infer or df[n].dtype != object:
+            df[n] = df[n].replace(v, 9999)
+        else:
+            # Replacing would infer the type of objects
+            values = df[n].to_numpy(copy=True)
+            values[df[n].isin(v).to_numpy()] = 9999
+            df[n] = values
+    return df
+
+
 def raw_to_compact(survey: database.Survey, df: pandas.DataFrame, defaults: Dict = {}) -> pandas.DataFrame:
     """Convert a raw Ankieter DataFrame into a compact format suitable for
     data analysis. The change is mainly about joining separate columns that
@@ -144,61 +289,429 @@ def raw_to_compact(survey: database.Survey, df: pandas.DataFrame, defaults: Dict
     :rtype: pandas.DataFrame
     """
 
-    # remove XML tags in question names
-    df.columns = df.columns.str.replace('</?\w[^>]*>', '', regex=True)
+    return compact(df, compact_plan(list(df.columns.values), defaults), defaults)
 
-    # remove all "czas wypełniania" columns
-    for column in df.filter(regex="czas wypełniania").columns:
-        df.drop(column, axis=1, inplace=True)
 
+class Progress:
+    """Progress of saving a source file to a survey database, reported as
+    percentages of its stages: parse, compact and write. Chunks are
+    compacted and written one after another, so the last two stages
+    advance together.
+    """
 
-    # Get all columns with \.\d+ prefixes, this is how Pandas marks repeated
-    # column names
-    repeats = df.filter(regex=r'\.\d+$').columns.values
+    def __init__(self, report: Optional[Callable[[str, int], None]] = None):
+        self.report = report
+        self.rows = None #: Number of rows in the file, known once it is parsed
+        self.percents = {}
+
+    def update(self, stage: str, done: float, total: Optional[float]):
+        """Report the done part of a stage, if the percentage changed.
+
+        :param stage: The stage, parse, compact or write
+        :type stage: str
+        :param done: The done part of the stage
+        :type done: float
+        :param total: The whole stage, or None if it is not known yet
+        :type total: Optional[float]
+        """
+
+        if self.report is None:
+            return
+        percent = min(100, int(100 * done / total)) if total else 0
+        if self.percents.get(stage) != percent:
+            self.percents[stage] = percent
+            self.report(stage, percent)
+
+
+def read_csv_chunks(path: str, separator: str, rows: int, progress: Optional[Progress] = None) -> Iterator[pandas.DataFrame]:
+    """Read a CSV file in chunks of rows. Columns of every chunk have the
+    types the whole file would be read with, so that every chunk is
+    converted the same way.
+
+    :param path: Path to the CSV file
+    :type path: str
+    :param separator: The separator used in the file
+    :type separator: str
+    :param rows: Number of rows in a chunk
+    :type rows: int
+    :param progress: Progress of parsing the file, by bytes read
+        (default: None)
+    :type progress: Optional[Progress]
+    :return: An iterator over the chunks
+    :rtype: Iterator[pandas.DataFrame]
+    """
 
-    # Get all column names which are not in 'repeats', these are base names
-    # of every column
-    uniques = [c for c in df.columns.values if c not in repeats]
+    progress = progress or Progress()
+
+    def read(file, **kwargs):
+        return pandas.read_csv(file, sep=separator, encoding='utf-8-sig', chunksize=rows, **kwargs)
+
+    # Find out what kinds of values columns of every chunk contain
+    kinds = {}
+    count = 0
+    size = os.path.getsize(path)
+    progress.rows = 0
+    with open(path, 'rb') as file:
+        for chunk in read(file):
+            if count == 0:
+                first = chunk
+            count += 1
+            progress.rows += len(chunk)
+            progress.update('parse', file.tell(), size)
+            add_kinds(kinds, chunk)
+    progress.update('parse', 1, 1)
+
+    # A file that fits in a single chunk doesn't have to be read again
+    if count == 1:
+        yield first
+        return
+    del first
+
+    dtypes, booleans = common_dtypes(kinds)
+    for chunk in read(path, dtype=dtypes):
+        yield objects_of_booleans(chunk, booleans)
+
+
+def add_kinds(kinds: Dict, chunk: pandas.DataFrame):
+    """Add the dtypes and the kinds of values of every column of a chunk to
+    those found in the chunks before.
+
+    :param kinds: Sets of dtypes and of kinds of columns, by column index
+    :type kinds: Dict
+    :param chunk: The chunk
+    :type chunk: pandas.DataFrame
+    """
 
-    # Now join repeated columns into one named by their base names
-    for u in uniques:
-        esc = re.escape(u)
-        group = list(df.filter(regex=esc+'\.\d+$').columns.values)
-        group.append(u)
-        df[u] = df[group].aggregate(nodefaults(defaults, u), axis='columns')
-        df = df.drop(group[:-1], axis='columns')
+    for i, (c, series) in enumerate(chunk.items()):
+        kind = series.dtype.kind
+        if series.isna().all():
+            kind = ''
+        elif kind == 'O' and pandas.api.types.infer_dtype(series, skipna=True) == 'boolean':
+            kind = 'b'
+        kinds.setdefault(i, (set(), set()))[0].add(series.dtype)
+        kinds[i][1].add(kind)
+
+
+def common_dtypes(kinds: Dict, numeric_booleans: Iterable[int] = ()) -> Tuple[Dict, List[int]]:
+    """Choose the types that columns of every chunk are read with, so that
+    they are the types of the columns of the whole file. Columns of
+    different types in different chunks contain numbers, booleans or
+    strings in the whole file.
+
+    :param kinds: Sets of dtypes and of kinds of columns, by column index, as
+        collected with add_kinds
+    :type kinds: Dict
+    :param numeric_booleans: Indices of columns whose boolean values are
+        parsed as numbers when mixed with numbers or missing values, as
+        boolean cells of spreadsheets are (default: ())
+    :type numeric_booleans: Iterable[int]
+    :return: The dtypes of columns by index, and indices of boolean columns
+        that have to be read as objects
+    :rtype: Tuple[Dict, List[int]]
+    """
 
-    # Convert all remaining defaults to the standard 9999
-    for k, v in defaults.items():
-        for c in df.columns.values:
-            if re.search(k, c):
-                df[c] = df[c].replace([int(x) for x in v], 9999)
+    dtypes = {}
+    booleans = []
+    for i, (types, kind) in kinds.items():
+        kind.discard('')
+        if len(types) == 1:
+            continue
+        if i in numeric_booleans and types <= {numpy.dtype('bool'), numpy.dtype('int64')}:
+            dtypes[i] = 'int64'
+        elif i in numeric_booleans and kind <= set('biuf'):
+            dtypes[i] = 'float64'
+        elif kind <= set('iuf'):
+            dtypes[i] = 'float64'
+        elif kind == {'b'}:
+            booleans.append(i)
+        else:
+            dtypes[i] = object
+    return dtypes, booleans
+
+
+def objects_of_booleans(chunk: pandas.DataFrame, booleans: List[int]) -> pandas.DataFrame:
+    """Make boolean columns of a chunk objects, as they are with missing
+    values.
+
+    :param chunk: The chunk
+    :type chunk: pandas.DataFrame
+    :param booleans: Indices of the boolean columns
+    :type booleans: List[int]
+    :return: The chunk
+    :rtype: pandas.DataFrame
+    """
 
-    return df
+    for i in booleans:
+        series = chunk.iloc[:, i]
+        if series.dtype != object:
+            # Like in a column read as objects, all NaNs are one object
+            values = series.to_numpy(dtype=object)
+            values[series.isna().to_numpy()] = numpy.nan
+            chunk[chunk.columns[i]] = values
+    return chunk
+
+
+# Values of cells with errors
+ERROR_STRINGS = {'#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A', '#GETTING_DATA'}
+
+
+def read_xlsx_chunks(path: str, rows: int, progress: Optional[Progress] = None) -> Iterator[pandas.DataFrame]:
+    """Read the first sheet of an XLSX workbook in chunks of rows, with a
+    read-only workbook. Cells are parsed like pandas.read_excel parses
+    them, and, like in read_csv_chunks, the sheet is read twice, so that
+    columns of every chunk have the types of the whole sheet. Dates and
+    times are read as text.
+
+    :param path: Path to the XLSX file
+    :type path: str
+    :param rows: Number of rows in a chunk, 0 for all of them
+    :type rows: int
+    :param progress: Progress of parsing the file, by rows read, if the
+        sheet declares its size (default: None)
+    :type progress: Optional[Progress]
+    :return: An iterator over the chunks
+    :rtype: Iterator[pandas.DataFrame]
+    """
+
+    progress = progress or Progress()
+
+    def value(v):
+        # Cells are converted like the openpyxl reader of pandas does
+        if v is None:
+            return ''
+        if isinstance(v, float) and v.is_integer():
+            return int(v)
+        if isinstance(v, (datetime.date, datetime.time)):
+            return str(v)
+        if isinstance(v, str) and v in ERROR_STRINGS:
+            return numpy.nan
+        return v
+
+    def sheet(numeric):
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+        try:
+            sheet = workbook.worksheets[0]
+            yield sheet.max_row
+            sheet.reset_dimensions()
+            empty = 0
+            for row in sheet.iter_rows(values_only=True):
+                row = [value(v) for v in row]
+                numeric.update(i for i, v in enumerate(row) if type(v) is bool)
+                while row and row[-1] == '':
+                    row.pop()
+                # Empty rows are skipped only at the end of the sheet
+                if not row:
+                    empty += 1
+                    continue
+                yield from [[]] * empty
+                empty = 0
+                yield row
+        finally:
+            workbook.close()
+
+    def read(cells, width=None, **kwargs):
+        # Rows are padded to the width of the sheet, or of the chunk until
+        # the width of the sheet is known
+        header = [str(v) for v in next(cells, [])]
+        chunk = list(itertools.islice(cells, rows or None))
+        start = 0
+        while True:
+            w = width or max([len(header)] + [len(row) for row in chunk])
+            pad = lambda row: row + [''] * (w - len(row))
+            data = [pad(header)] + [pad(row) for row in chunk]
+            df = TextParser(data, header=0, skip_blank_lines=False, **kwargs).read()
+            # Number the rows like in the whole sheet
+            df.index = pandas.RangeIndex(start, start + len(df))
+            yield w, df
+            start += len(df)
+            chunk = list(itertools.islice(cells, rows or None))
+            if not chunk:
+                break
+
+    # Find out what kinds of values columns of every chunk contain, and the
+    # width of the sheet
+    # Boolean cells are numbers to the parser, unlike boolean strings
+    numeric = set()
+    cells = sheet(numeric)
+    size = next(cells)
+    kinds = {}
+    widths = []
+    progress.rows = 0
+    for w, chunk in read(cells):
+        if not widths:
+            first = chunk
+        widths.append(w)
+        progress.rows += len(chunk)
+        progress.update('parse', progress.rows, size and size - 1)
+        add_kinds(kinds, chunk)
+    progress.update('parse', 1, 1)
+
+    # A sheet that fits in a single chunk doesn't have to be read again
+    if len(widths) == 1:
+        yield first
+        return
+    del first
+
+    # Columns missing from rows of a chunk are empty in it
+    width = max(widths)
+    for w in widths:
+        for i in range(w, width):
+            kinds.setdefault(i, (set(), set()))[0].add(numpy.dtype('float64'))
+            kinds[i][1].add('')
+
+    dtypes, booleans = common_dtypes(kinds, numeric)
+    cells = sheet(set())
+    next(cells)
+    for _, chunk in read(cells, width, dtype=dtypes):
+        yield objects_of_booleans(chunk, booleans)
+
+
+# SQL types of values, as pandas.DataFrame.to_sql chooses them
+SQL_TYPES = {
+    'string':   'TEXT',
+    'floating': 'REAL',
+    'integer':  'INTEGER',
+    'datetime': 'TIMESTAMP',
+    'date':     'DATE',
+    'time':     'TIME',
+    'boolean':  'INTEGER',
+}
+
+
+def write_data(conn: sqlite3.Connection, frames: Iterable[pandas.DataFrame]):
+    """Replace the data of a survey database with the rows of the frames, in
+    a single transaction. The result is the same as if the concatenated
+    frames, with types of objects inferred, were written with
+    pandas.DataFrame.to_sql, but only one frame at a time is in memory.
+
+    :param conn: Connection to the survey database
+    :type conn: sqlite3.Connection
+    :param frames: DataFrames with the same columns
+    :type frames: Iterable[pandas.DataFrame]
+    :return: The number of rows written
+    :rtype: int
+    """
+
+    quote = lambda name: '"' + str(name).replace('"', '""') + '"'
+
+    # Values are saved without type affinity until types of all of them are
+    # known, as SQLite would convert them depending on the declared type
+    conn.execute('BEGIN')
+    try:
+        conn.execute('DROP TABLE IF EXISTS data_chunks')
+        dtypes = None
+        count = 0
+        for df in frames:
+            count += len(df)
+            df = df.reset_index()
+            if dtypes is None:
+                dtypes = {c: [] for c in df.columns}
+                kinds = {c: set() for c in df.columns}
+                conn.execute(f'CREATE TABLE data_chunks ({", ".join(quote(c) for c in df.columns)})')
+
+            values = []
+            for c, series in df.items():
+                # Missing values make numbers floats, like NaNs do
+                dtype = series.infer_objects().dtype
+                dtypes[c].append(numpy.dtype('float64') if series.isna().all() else dtype)
+                kinds[c].add(pandas.api.types.infer_dtype(series, skipna=True))
+                if series.dtype.kind == 'M':
+                    column = numpy.array(series.dt.to_pydatetime(), dtype=object)
+                elif series.dtype.kind == 'm':
+                    column = series.to_numpy().view('i8').astype(object)
+                else:
+                    column = series.to_numpy(dtype=object)
+                column[pandas.isna(column)] = None
+                values.append(column)
+            conn.executemany(f'INSERT INTO data_chunks VALUES ({", ".join("?" * len(values))})', zip(*values))
+
+        types = {}
+        for c in dtypes:
+            if len(set(dtypes[c])) == 1:
+                dtype = dtypes[c][0]
+            elif all(d.kind in 'iuf' for d in dtypes[c]):
+                dtype = numpy.dtype('float64')
+            else:
+                dtype = numpy.dtype(object)
+            if dtype == object:
+                kinds[c].discard('empty')
+                kind = kinds[c].pop() if len(kinds[c]) == 1 else 'mixed'
+            else:
+                kind = pandas.api.types.infer_dtype(numpy.empty(0, dtype=dtype))
+            if kind == 'complex':
+                raise ValueError('Complex datatypes not supported')
+            kind = {'timedelta64': 'integer', 'datetime64': 'datetime'}.get(kind, kind)
+            types[c] = SQL_TYPES.get(kind, 'TEXT')
+
+        conn.execute('DROP TABLE IF EXISTS data')
+        conn.execute(f'CREATE TABLE data ({", ".join(f"{quote(c)} {t}" for c, t in types.items())})')
+        conn.execute('INSERT INTO data SELECT * FROM data_chunks')
+        conn.execute('DROP TABLE data_chunks')
+        index = next(iter(types))
+        conn.execute(f'CREATE INDEX {quote(f"ix_data_{index}")} ON data ({quote(index)})')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
 
 
-def csv_to_db(survey: database.Survey, filename: str, defaults: Dict = {}):
-    """Read the source CSV file and save it to a new database
+def csv_to_db(survey: database.Survey, filename: str, defaults: Dict = {}, report: Optional[Callable[[str, int], None]] = None):
+    """Read the source CSV, XLSX or XLS file and save it to a new database.
+    Data is converted and written in chunks of CSV_CHUNK_ROWS rows, CSV and
+    XLSX files are also read that way, so that they don't have to fit in
+    memory.
 
     :param survey: The Survey
     :type survey: Survey
-    :param filename: Name of the source CSV file in the raw/ directory
+    :param filename: Name of the source file in the raw/ directory
     :type filename: str
     :param defaults: A dict with default values set for each column name
     :type defaults: Dict
+    :param report: Called with a stage (parse, compact or write) and its
+        percentage every time the progress changes (default: None)
+    :type report: Optional[Callable[[str, int], None]]
     """
 
+    progress = Progress(report)
     try:
         name, ext = filename.rsplit('.', 1)
-        if ext != "csv":
-            file = pandas.read_excel(f'raw/{name}.{ext}')
-            file.to_csv(f'raw/{name}.csv', encoding='utf-8')
-            filename = f'{name}.csv'
-        separator = detect_csv_sep(filename)
-        df = pandas.read_csv(f"raw/{filename}", sep=separator, encoding='utf-8-sig')
-
-        # convert the data to a format suitable for data analysis
-        df = raw_to_compact(survey, df, defaults)
+        if ext.lower() == "csv":
+            separator = detect_csv_sep(filename)
+            if CSV_CHUNK_ROWS > 0:
+                chunks = read_csv_chunks(f"raw/{filename}", separator, CSV_CHUNK_ROWS, progress)
+            else:
+                df = pandas.read_csv(f"raw/{filename}", sep=separator, encoding='utf-8-sig')
+                progress.rows = len(df)
+                progress.update('parse', 1, 1)
+                chunks = iter([df])
+                del df
+        else:
+            if ext.lower() == "xlsx":
+                chunks = read_xlsx_chunks(f"raw/{filename}", CSV_CHUNK_ROWS, progress)
+            else:
+                df = pandas.read_excel(f"raw/{filename}")
+                progress.rows = len(df)
+                progress.update('parse', 1, 1)
+                rows = CSV_CHUNK_ROWS or max(len(df), 1)
+                chunks = (df.iloc[i:i+rows] for i in range(0, max(len(df), 1), rows))
+
+        # convert the data to a format suitable for data analysis, every
+        # chunk with the same plan
+        first = next(chunks)
+        plan = compact_plan(list(first.columns.values), defaults)
+
+        def frames(chunks):
+            done = 0
+            for chunk in chunks:
+                df = compact(chunk, plan, defaults, infer=False)
+                progress.update('compact', done + len(df), progress.rows)
+                yield df
+                done += len(df)
+                progress.update('write', done, progress.rows)
+
+        chunks = itertools.chain([first], chunks)
+        del first
 
         # if defaults is not empty, there exists an XML to which the data must be adjusted
         # if defaults:
@@ -210,8 +723,14 @@ def csv_to_db(survey: database.Survey, filename: str, defaults: Dict = {}):
         #         raise err
 
         conn = database.open_survey(survey)
-        df.to_sql("data", conn, if_exists="replace")
-        conn.close()
+        try:
+            count = write_data(conn, frames(chunks))
+        finally:
+            conn.close()
+        pool.SURVEYS.invalidate(survey.id)
+        store.build(survey)
+        database.set_answers_count(survey, count)
+        progress.update('write', 1, 1)
         return True
     except error.API as err:
         err.add_details('could not save save the data')
@@ -324,6 +843,7 @@ def json_to_xml(survey: database.Survey, survey_json):
                 print(' </questions>',file=xml_out)
                 print('</page>\n', file=xml_out)
         print('</questionnaire>',file=xml_out)
+    definitions.invalidate(survey.id)
 
 
 def xml_to_json(survey: database.Survey):
@@ -399,30 +919,33 @@ def xml_to_json(survey: database.Survey):
 
         return res
 
-    json_out={"elements": [], "title": ""}
+    def read(xml):
+        elements = []
+        questions = ["page","text","information","groupedsingle","single","multi"]
+        for child in xml.getroot():
+            result={}
+            if child.tag in questions:
+                if child.tag == "page":
+                    result["header"] = ""
+                    if child.find("header").text:
+                        result["header"] = child.find("header").text
+                    result["id"] = child.get("id","")
+                    result["elements"]=[]
+                    result["maxLength"]=int(child.get("maxLength",250))
+                    result["questionType"] = child.tag
+                    c = child.find("questions")
+                    for q in c:
+                        sub_question={}
+                        result["elements"].append(write_element(q, sub_question))
+                else:
+                    result = write_element(child,result)
+
+                elements.append(result)
+        return elements
 
-    xml = ET.parse(f"survey/{survey.id}.xml")
-    questions = ["page","text","information","groupedsingle","single","multi"]
+    json_out={"elements": [], "title": ""}
     json_out["title"]=survey.Name
-    for child in xml.getroot():
-        result={}
-        if child.tag in questions:
-            if child.tag == "page":
-                result["header"] = ""
-                if child.find("header").text:
-                    result["header"] = child.find("header").text
-                result["id"] = child.get("id","")
-                result["elements"]=[]
-                result["maxLength"]=int(child.get("maxLength",250))
-                result["questionType"] = child.tag
-                c = child.find("questions")
-                for q in c:
-                    sub_question={}
-                    result["elements"].append(write_element(q, sub_question))
-            else:
-                result = write_element(child,result)
-
-            json_out["elements"].append(result)
+    json_out["elements"]=definitions.load(survey.id).get('elements', read)
 
     json_format=json.dumps(json_out)
     return json_format
@@ -1,12 +1,26 @@
 from globals import *
+import threading
 import time
 
 LIST = []
+STARTED = False
+LOCK = threading.Lock()
 
 def daemon(f):
     LIST.append(f)
     return f
 
+def start():
+    """Start a thread for every daemon, only once in a process"""
+
+    global STARTED
+    with LOCK:
+        if STARTED:
+            return
+        STARTED = True
+    for d in LIST:
+        threading.Thread(target=d, daemon=True).start()
+
 #@daemon
 def gather():
     while True:
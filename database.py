@@ -1,10 +1,19 @@
-from typing import Literal, Any, List, Dict
+from typing import Literal, Any, List, Dict, Optional, Iterator, Tuple
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import selectinload
+from sqlalchemy.engine import Engine
+from sqlalchemy import inspect, event
 from base64 import b32encode
-from flask import session
+from datetime import datetime, timedelta
+from flask import session, g, has_request_context
 from globals import *
-import xml.etree.ElementTree as ET
 import sqlite3
+import json
+import pool
+import cache
+import definitions
 import secrets
 import random
 import error
@@ -14,20 +23,45 @@ import os
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def configure_connection(dbapi_connection, connection_record):
+    """Configure new connections to master.db. Readers don't wait for the
+    writer in the WAL mode, and the writers wait for each other instead of
+    failing with "database is locked".
+    """
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA busy_timeout = {int(DATABASE_TIMEOUT * 1000)}')
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
 Role = Literal['s', 'u', 'g']
 Permission = Literal['o', 'w', 'r', 'n']
 
 PERMISSION_ORDER = ['n', 'r', 'w', 'o']
 
+# Schemas of survey databases, by data version
+SCHEMAS = cache.LRU(256)
+
 
 class User(db.Model):
     __tablename__ = "Users"
     id = db.Column(db.Integer, primary_key=True) #: User Id
     CasLogin = db.Column(db.String(80), unique=True, nullable=False) #: CAS Login
+    Login = db.Column(db.String(80), index=True) #: CAS Login without the domain, set with CasLogin
     Pesel = db.Column(db.String(11), nullable=True) #: PESEL number of the user
     FetchData = db.Column(db.Boolean, nullable=False) #: No use of this value is implemented yet
     Role = db.Column(db.String, default='g', nullable=False) #: The user's role in the system
 
+    @db.validates('CasLogin')
+    def set_login(self, key, cas_login):
+        self.Login = cas_login.split('@')[0]
+        return cas_login
+
     def as_dict(self):
         ud = {
             "id":        self.id,
@@ -50,8 +84,11 @@ class Survey(db.Model):
     EndsOn = db.Column(db.DateTime, nullable=True) #: End date of the survey
     IsActive = db.Column(db.Integer, nullable=True) #: No use of this value is implemented yet
     QuestionCount = db.Column(db.Integer, nullable=True) #: Number of questions in the survey
+    AnswersCount = db.Column(db.Integer, nullable=True) #: Number of answers in the survey database, saved when the data is written
     BackgroundImg = db.Column(db.String(50), default=None) #: Filename of the survey's backgroun image in the menu
     AuthorId = db.Column(db.Integer, db.ForeignKey('Users.id')) #: Id of the user who created the survey
+    Author = db.relationship('User') #: The user who created the survey
+    Permissions = db.relationship('SurveyPermission') #: Permissions of users to the survey
 
 
 class Report(db.Model):
@@ -61,12 +98,15 @@ class Report(db.Model):
     SurveyId = db.Column(db.Integer, db.ForeignKey('Surveys.id'), nullable=False) #: Id of the source survey
     BackgroundImg = db.Column(db.String(50)) #: Filename of the report's background image in the menu
     AuthorId = db.Column(db.Integer, db.ForeignKey('Users.id')) #: Id of the user who created the report
+    ConnectedSurvey = db.relationship('Survey') #: The source survey
+    Author = db.relationship('User') #: The user who created the report
+    Permissions = db.relationship('ReportPermission') #: Permissions of users to the report
 
 
 class UserGroup(db.Model):
     __tablename__ = "UserGroups"
     UserId = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True)
-    Group = db.Column(db.String(25), primary_key=True)
+    Group = db.Column(db.String(25), primary_key=True, index=True)
 
 
 class SurveyGroup(db.Model):
@@ -84,14 +124,14 @@ class ReportGroup(db.Model):
 class SurveyPermission(db.Model):
     __tablename__ = "SurveyPermissions"
     SurveyId = db.Column(db.Integer, db.ForeignKey('Surveys.id'), primary_key=True) #: The Id of the survey the permission is to
-    UserId = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True) #: The Id of the user that holds the permission
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True, index=True) #: The Id of the user that holds the permission
     Type = db.Column(db.String, default='r', nullable=False) #: The type of the permission
 
 
 class ReportPermission(db.Model):
     __tablename__ = "ReportPermissions"
     ReportId = db.Column(db.Integer, db.ForeignKey('Reports.id'), primary_key=True) #: The Id of the report the permission is to
-    UserId = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True) #: The Id of the user that holds the permission
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True, index=True) #: The Id of the user that holds the permission
     Type = db.Column(db.String, default='r', nullable=False) #: The type of the permission
 
 
@@ -104,8 +144,106 @@ class Link(db.Model):
     ObjectId = db.Column(db.Integer, nullable=False) #: Id of the object the permission is to
 
 
+class Job(db.Model):
+    __tablename__ = "Jobs"
+    id = db.Column(db.Integer, primary_key=True) #: Job Id
+    SurveyId = db.Column(db.Integer, db.ForeignKey('Surveys.id'), nullable=False) #: Id of the survey the data is saved to
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.id')) #: Id of the user who uploaded the data
+    Filename = db.Column(db.String, nullable=False) #: Name of the uploaded file in the raw/ directory
+    Defaults = db.Column(db.String, default='{}', nullable=False) #: Default values of the survey's questions, as JSON
+    State = db.Column(db.String, default='queued', nullable=False) #: One of: queued, running, done, failed
+    Parse = db.Column(db.Integer, default=0, nullable=False) #: Percentage of the file parsed
+    Compact = db.Column(db.Integer, default=0, nullable=False) #: Percentage of the rows compacted
+    Write = db.Column(db.Integer, default=0, nullable=False) #: Percentage of the rows written to the survey database
+    Error = db.Column(db.String, nullable=True) #: Why the job failed
+    CreatedOn = db.Column(db.DateTime, nullable=False) #: When the job was queued
+    UpdatedOn = db.Column(db.DateTime, nullable=False) #: When the state or progress of the job last changed
+
+    def as_dict(self):
+        return {
+            "id":        self.id,
+            "surveyId":  self.SurveyId,
+            "state":     self.State,
+            "progress":  {"parse": self.Parse, "compact": self.Compact, "write": self.Write},
+            "error":     self.Error,
+            "createdOn": self.CreatedOn.timestamp(),
+            "updatedOn": self.UpdatedOn.timestamp(),
+        }
+
+
+class Context:
+    """The logged in user and their permissions, resolved once in a request
+    and kept in flask.g
+    """
+
+    def __init__(self, username: str, user: User):
+        self.username = username #: The login from the session
+        self.user = user #: The logged in user
+        self.permissions = None
+
+    def permission(self, object_type: Literal['s', 'r'], object_id: int) -> Optional[str]:
+        """Get a permission of the user, loading all of them the first time.
+
+        :param object_type: Type of the object, 's' for surveys and 'r' for
+            reports
+        :type object_type: Literal['s', 'r']
+        :param object_id: Id of the object
+        :type object_id: int
+        :return: The type of the permission, or None if there is none
+        :rtype: Optional[str]
+        """
+
+        if self.permissions is None:
+            self.permissions = {}
+            surveys = db.session.query(SurveyPermission.SurveyId, SurveyPermission.Type).filter_by(UserId=self.user.id)
+            reports = db.session.query(ReportPermission.ReportId, ReportPermission.Type).filter_by(UserId=self.user.id)
+            for id, type in surveys:
+                self.permissions[('s', id)] = type
+            for id, type in reports:
+                self.permissions[('r', id)] = type
+        return self.permissions.get((object_type, object_id))
+
+    def set_permission(self, object_type: Literal['s', 'r'], object_id: int, permission: Permission):
+        """Update a permission of the user, after it was saved.
+
+        :param object_type: Type of the object, 's' for surveys and 'r' for
+            reports
+        :type object_type: Literal['s', 'r']
+        :param object_id: Id of the object
+        :type object_id: int
+        :param permission: The new permission
+        :type permission: Permission
+        """
+
+        if self.permissions is None:
+            return
+        if permission == 'n':
+            self.permissions.pop((object_type, object_id), None)
+        else:
+            self.permissions[(object_type, object_id)] = permission
+
+
+def get_context(user: User) -> Optional[Context]:
+    """Get the request context of a user.
+
+    :param user: The user
+    :type user: User
+    :return: The context, or None if the user isn't the one logged in in
+        the current request
+    :rtype: Optional[Context]
+    """
+
+    if not has_request_context():
+        return None
+    context = g.get('context')
+    if context is None or context.user is None or context.user.id != user.id:
+        return None
+    return context
+
+
 def get_user(login: Any = "") -> User:
-    """Get a user object from DB.
+    """Get a user object from DB. The logged in user is resolved only once
+    in a request.
 
     :param login: User's CAS login, id or guest if empty string (default: "")
     :raises error.API: no such user
@@ -118,19 +256,24 @@ def get_user(login: Any = "") -> User:
         # zamiast tego blędu, jeśli nie ma loginu, to przydziel gościa
         if 'username' not in session:
             session['username'] = GUEST_NAME
+        context = g.get('context')
+        if context is not None and context.username == session['username']:
+            return context.user
         if session['username'] == GUEST_NAME:
-            return User.query.filter_by(Role='g').first()
-        login = session['username']
+            user = User.query.filter_by(Role='g').first()
+        elif session['username']:
+            user = get_user(session['username'])
+        else:
+            raise error.API(f'no such user {login}')
+        g.context = Context(session['username'], user)
+        return user
     if type(login) is str:
         if '@' in login:
             user = User.query.filter_by(CasLogin=login).first()
         elif re.match("[0-9]+", login):
             user = User.query.filter_by(Pesel=login).first()
         else:
-            users = get_all_users()
-            for u in users["users"]:
-                if u["casLogin"].split("@")[0] == login:
-                    user = User.query.filter_by(id=u["id"]).first()
+            user = User.query.filter_by(Login=login).order_by(User.id.desc()).first()
     if type(login) is int:
         user = User.query.filter_by(id=login).first()
     if user is None:
@@ -138,6 +281,54 @@ def get_user(login: Any = "") -> User:
     return user
 
 
+def get_users(logins: List[Any]) -> List[User]:
+    """Get many user objects from DB at once, each found the way get_user
+    finds it.
+
+    :param logins: Users' CAS logins or ids
+    :type logins: List[Any]
+    :raises error.API: no such user
+    :return: User objects, in the order of the logins
+    :rtype: List[User]
+    """
+
+    def kind(login):
+        if type(login) is int:
+            return 'id'
+        if type(login) is not str or not login:
+            return None
+        if '@' in login:
+            return 'email'
+        if re.match("[0-9]+", login):
+            return 'pesel'
+        return 'short'
+
+    kinds = {kind(l) for l in logins}
+    found = {'id': {}, 'email': {}, 'pesel': {}, 'short': {}, None: {}}
+    if 'id' in kinds:
+        ids = [l for l in logins if kind(l) == 'id']
+        found['id'] = {u.id: u for u in User.query.filter(User.id.in_(ids))}
+    if 'email' in kinds:
+        emails = [l for l in logins if kind(l) == 'email']
+        found['email'] = {u.CasLogin: u for u in User.query.filter(User.CasLogin.in_(emails))}
+    if 'pesel' in kinds:
+        pesels = [l for l in logins if kind(l) == 'pesel']
+        for u in User.query.filter(User.Pesel.in_(pesels)).order_by(User.id):
+            found['pesel'].setdefault(u.Pesel, u)
+    if 'short' in kinds:
+        short = [l for l in logins if kind(l) == 'short']
+        for u in User.query.filter(User.Login.in_(short)).order_by(User.id):
+            found['short'][u.Login] = u
+
+    users = []
+    for login in logins:
+        user = found[kind(login)].get(login) if kind(login) else None
+        if user is None:
+            raise error.API(f'no such user {login}')
+        users.append(user)
+    return users
+
+
 def create_user(cas_login: str, pesel: str, role: str) -> User:
     """Create a new user.
 
@@ -371,11 +562,21 @@ def set_user_group(user: User, group_name: str):
     :type group_name: str
     """
 
-    user_group = UserGroup.query.filter_by(UserId=user.id, Group=group_name).first()
-    if user_group is None:
-        user_group = UserGroup(UserId=user.id, Group=group_name)
-        db.session.add(user_group)
-        db.session.commit()
+    set_users_groups({group_name: [user]})
+
+
+def set_users_groups(groups: Dict[str, List[User]]):
+    """Add many users to groups in a single transaction. Users already in
+    a group are skipped.
+
+    :param groups: Users to be added, by group name
+    :type groups: Dict[str, List[User]]
+    """
+
+    rows = [{'UserId': user.id, 'Group': group} for group, users in groups.items() for user in users]
+    if rows:
+        db.session.execute(insert(UserGroup.__table__).on_conflict_do_nothing(), rows)
+    db.session.commit()
 
 
 def unset_user_group(user: User, group: str):
@@ -387,10 +588,19 @@ def unset_user_group(user: User, group: str):
     :type group: str
     """
 
-    user_group = UserGroup.query.filter_by(UserId=user.id, Group=group)
-    if user_group is None:
-        raise error.API('the user is not in the group')
-    user_group.delete()
+    unset_users_groups({group: [user]})
+
+
+def unset_users_groups(groups: Dict[str, List[User]]):
+    """Remove many users from groups in a single transaction.
+
+    :param groups: Users to be removed, by group name
+    :type groups: Dict[str, List[User]]
+    """
+
+    for group, users in groups.items():
+        query = UserGroup.query.filter(UserGroup.Group == group, UserGroup.UserId.in_([u.id for u in users]))
+        query.delete(synchronize_session=False)
     db.session.commit()
 
 
@@ -409,6 +619,44 @@ def get_user_groups(user: User) -> List[str]:
     return [user_group.Group for user_group in user_groups]
 
 
+def query_user_surveys(user: User):
+    """Get a query of surveys for which the user has permissions, also
+    temporary ones from the session. For administrators it queries all
+    surveys.
+
+    :param user: User object
+    :type user: User
+
+    :return: Query of Survey objects
+    :rtype: flask_sqlalchemy.BaseQuery
+    """
+
+    if user.Role == 's':
+        return Survey.query
+    shared = db.session.query(SurveyPermission.SurveyId).filter_by(UserId=user.id)
+    linked = [int(id) for id in session.get('surveys', [])]
+    return Survey.query.filter(db.or_(Survey.id.in_(shared), Survey.id.in_(linked)))
+
+
+def query_user_reports(user: User):
+    """Get a query of reports for which the user has permissions, also
+    temporary ones from the session. For administrators it queries all
+    reports.
+
+    :param user: User object
+    :type user: User
+
+    :return: Query of Report objects
+    :rtype: flask_sqlalchemy.BaseQuery
+    """
+
+    if user.Role == 's':
+        return Report.query
+    shared = db.session.query(ReportPermission.ReportId).filter_by(UserId=user.id)
+    linked = [int(id) for id in session.get('reports', [])]
+    return Report.query.filter(db.or_(Report.id.in_(shared), Report.id.in_(linked)))
+
+
 def get_user_surveys(user: User) -> List[Survey]:
     """Get surveys for which the user has permissions.
     For administrators it returns all surveys.
@@ -420,16 +668,7 @@ def get_user_surveys(user: User) -> List[Survey]:
     :rtype: List[Survey]
     """
 
-    if user.Role == 's':
-        return Survey.query.all()
-    user_surveys = SurveyPermission.query.filter_by(UserId=user.id).all()
-    surveys = []
-    for survey in user_surveys:
-        surveys.append(Survey.query.filter_by(id=survey.SurveyId).first())
-    if 'surveys' in session:
-        for id in session['surveys']:
-            surveys.append(Survey.query.filter_by(id=int(id)).first())
-    return surveys
+    return query_user_surveys(user).all()
 
 
 def get_user_reports(user: User) -> List[Report]:
@@ -443,16 +682,7 @@ def get_user_reports(user: User) -> List[Report]:
     :rtype: List[Report]
     """
 
-    if user.Role == 's':
-        return Report.query.all()
-    user_reports = ReportPermission.query.filter_by(UserId=user.id).all()
-    reports = []
-    for report in user_reports:
-        reports.append(Report.query.filter_by(id=report.ReportId).first())
-    if 'reports' in session:
-        for id in session['reports']:
-            reports.append(Report.query.filter_by(id=int(id)).first())
-    return reports
+    return query_user_reports(user).all()
 
 
 def get_group_users(group: str) -> List[User]:
@@ -465,13 +695,25 @@ def get_group_users(group: str) -> List[User]:
     :rtype: List[User]
     """
 
-    user_groups = UserGroup.query.filter_by(Group=group).all()
-    users = []
-    for user_group in user_groups:
-        user = User.query.filter_by(id=user_group.UserId).first()
+    query = User.query.join(UserGroup, UserGroup.UserId == User.id)
+    return query.filter(UserGroup.Group == group).order_by(User.id).all()
+
+
+def get_all_groups() -> Dict[str, List[dict]]:
+    """Get all groups with their users, using a single query.
+
+    :return: Users serialized with User.as_dict, by group name
+    :rtype: Dict[str, List[dict]]
+    """
+
+    query = db.session.query(UserGroup.Group, User)
+    query = query.outerjoin(User, UserGroup.UserId == User.id)
+    result = {}
+    for group, user in query.order_by(UserGroup.Group, UserGroup.UserId):
+        users = result.setdefault(group, [])
         if user is not None:
-            users.append(user)
-    return users
+            users.append(user.as_dict())
+    return result
 
 
 def rename_report(report: Report, name: str):
@@ -575,15 +817,21 @@ def get_survey_permission(survey: Survey, user: User) -> Permission:
     :rtype: Permission
     """
 
-    if 'surveys' in session and str(survey.id) in session['surveys']:
-        return session['surveys'][str(survey.id)]
+    return get_survey_permissions([survey], user)[survey.id]
 
-    sp = SurveyPermission.query.filter_by(SurveyId=survey.id, UserId=user.id).first()
-    if sp is None and user.Role == 's':
-        return ADMIN_DEFAULT_PERMISSION
-    elif sp is None:
-        return 'n'
-    return sp.Type
+
+def get_survey_permissions(surveys: List[Survey], user: User) -> Dict[int, Permission]:
+    """Get permissions of given user for many surveys at once.
+
+    :param surveys: The surveys
+    :type surveys: List[Survey]
+    :param user: The user whose permissions are to be checked
+    :type user: User
+    :return: The user's permissions, by survey id
+    :rtype: Dict[int, Permission]
+    """
+
+    return get_permissions('s', [s.id for s in surveys], user)
 
 
 def set_survey_permission(survey: Survey, user: User, permission: Permission, bylink=False):
@@ -608,15 +856,20 @@ def set_survey_permission(survey: Survey, user: User, permission: Permission, by
             session['surveys'][survey.id] = 'r'
         return
 
-    sp = SurveyPermission.query.filter_by(SurveyId=survey.id, UserId=user.id).first()
-    if sp is None:
-        sp = SurveyPermission(SurveyId=survey.id, UserId=user.id)
-        db.session.add(sp)
-    if permission != "n":
-        sp.Type = permission
-    else:
-        db.session.delete(sp)
-    db.session.commit()
+    set_permissions('s', survey.id, [(user, permission)])
+
+
+def set_survey_permissions(survey: Survey, permissions: List[Tuple[User, Permission]]):
+    """Set permissions of many users for survey in a single transaction.
+
+    :param survey: The survey
+    :type survey: Survey
+    :param permissions: Users with their new permissions, if a user is
+        given more than once the last permission is set
+    :type permissions: List[Tuple[User, Permission]]
+    """
+
+    set_permissions('s', survey.id, permissions)
 
 
 def get_report_survey(report: Report) -> Survey:
@@ -645,15 +898,61 @@ def get_report_permission(report: Report, user: User) -> Permission:
     :rtype: Permission
     """
 
-    if 'reports' in session and str(report.id) in session['reports']:
-        return session['reports'][str(report.id)]
+    return get_report_permissions([report], user)[report.id]
 
-    rp = ReportPermission.query.filter_by(ReportId=report.id, UserId=user.id).first()
-    if rp is None and user.Role == 's':
-        return ADMIN_DEFAULT_PERMISSION
-    if rp is None:
-        return 'n'
-    return rp.Type
+
+def get_report_permissions(reports: List[Report], user: User) -> Dict[int, Permission]:
+    """Get permissions of given user for many reports at once.
+
+    :param reports: The reports
+    :type reports: List[Report]
+    :param user: The user whose permissions are to be checked
+    :type user: User
+    :return: The user's permissions, by report id
+    :rtype: Dict[int, Permission]
+    """
+
+    return get_permissions('r', [r.id for r in reports], user)
+
+
+def get_permissions(object_type: Literal['s', 'r'], ids: List[int], user: User) -> Dict[int, Permission]:
+    """Get permissions of given user for many surveys or reports. Temporary
+    permissions from the session come first, permissions of the logged in
+    user are taken from the request context.
+
+    :param object_type: Type of the objects, 's' for surveys and 'r' for
+        reports
+    :type object_type: Literal['s', 'r']
+    :param ids: Ids of the objects
+    :type ids: List[int]
+    :param user: The user whose permissions are to be checked
+    :type user: User
+    :return: The user's permissions, by object id
+    :rtype: Dict[int, Permission]
+    """
+
+    linked = session.get('surveys' if object_type == 's' else 'reports', {})
+    context = get_context(user)
+    if context is not None:
+        found = {id: context.permission(object_type, id) for id in ids}
+    elif object_type == 's':
+        query = db.session.query(SurveyPermission.SurveyId, SurveyPermission.Type)
+        found = dict(query.filter(SurveyPermission.UserId == user.id, SurveyPermission.SurveyId.in_(ids)))
+    else:
+        query = db.session.query(ReportPermission.ReportId, ReportPermission.Type)
+        found = dict(query.filter(ReportPermission.UserId == user.id, ReportPermission.ReportId.in_(ids)))
+
+    result = {}
+    for id in ids:
+        if str(id) in linked:
+            result[id] = linked[str(id)]
+        elif found.get(id) is not None:
+            result[id] = found[id]
+        elif user.Role == 's':
+            result[id] = ADMIN_DEFAULT_PERMISSION
+        else:
+            result[id] = 'n'
+    return result
 
 
 def set_report_permission(report: Report, user: User, permission: Permission, bylink=False):
@@ -678,16 +977,67 @@ def set_report_permission(report: Report, user: User, permission: Permission, by
             session['reports'][report.id] = 'r'
         return
 
-    rp = ReportPermission.query.filter_by(ReportId=report.id, UserId=user.id).first()
-    if rp is None:
-        rp = ReportPermission(ReportId=report.id, UserId=user.id)
-        db.session.add(rp)
-    if permission != "n":
-        rp.Type = permission
+    set_permissions('r', report.id, [(user, permission)])
+
+
+def set_report_permissions(report: Report, permissions: List[Tuple[User, Permission]]):
+    """Set permissions of many users for report in a single transaction.
+
+    :param report: The report
+    :type report: Report
+    :param permissions: Users with their new permissions, if a user is
+        given more than once the last permission is set
+    :type permissions: List[Tuple[User, Permission]]
+    """
+
+    set_permissions('r', report.id, permissions)
+
+
+def set_permissions(object_type: Literal['s', 'r'], object_id: int, permissions: List[Tuple[User, Permission]]):
+    """Set permissions of many users for a survey or a report. New and
+    changed permissions are upserted, and the 'n' permissions are deleted,
+    all in a single transaction.
+
+    :param object_type: Type of the object, 's' for surveys and 'r' for
+        reports
+    :type object_type: Literal['s', 'r']
+    :param object_id: Id of the object
+    :type object_id: int
+    :param permissions: Users with their new permissions, if a user is
+        given more than once the last permission is set
+    :type permissions: List[Tuple[User, Permission]]
+    """
+
+    if object_type == 's':
+        model, key = SurveyPermission, 'SurveyId'
     else:
-        db.session.delete(rp)
+        model, key = ReportPermission, 'ReportId'
+
+    users = {}
+    latest = {}
+    for user, permission in permissions:
+        users[user.id] = user
+        latest[user.id] = permission
+
+    revoked = [id for id, p in latest.items() if p == 'n']
+    granted = [{key: object_id, 'UserId': id, 'Type': p} for id, p in latest.items() if p != 'n']
+    if revoked:
+        query = model.query.filter(getattr(model, key) == object_id, model.UserId.in_(revoked))
+        query.delete(synchronize_session=False)
+    if granted:
+        upsert = insert(model.__table__)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[key, 'UserId'],
+            set_={'Type': upsert.excluded.Type}
+        )
+        db.session.execute(upsert, granted)
     db.session.commit()
 
+    for id, permission in latest.items():
+        context = get_context(users[id])
+        if context is not None:
+            context.set_permission(object_type, object_id, permission)
+
 
 def create_report(user: User, survey: Survey, name: str, author: int) -> Report:
     """Create report for a given user
@@ -727,6 +1077,7 @@ def delete_survey(survey: Survey):
     #     os.remove(xml_path)
     SurveyPermission.query.filter_by(SurveyId=survey.id).delete()
     SurveyGroup.query.filter_by(SurveyId=survey.id).delete()
+    Job.query.filter_by(SurveyId=survey.id).delete()
     Survey.query.filter_by(id=survey.id).delete()
     db.session.commit()
 
@@ -756,43 +1107,90 @@ def open_survey(survey: Survey) -> sqlite3.Connection:
     return sqlite3.connect(f"data/{survey.id}.db")
 
 
+@contextmanager
+def read_survey(survey: Survey, version: Optional[tuple] = None) -> Iterator[sqlite3.Connection]:
+    """Borrow a read-only connection to the survey database from the pool,
+    for a version of the data. Results read through the connection should
+    be cached under the same version that it was borrowed for.
+
+    :param survey: The survey
+    :type survey: Survey
+    :param version: The data version, as returned from get_data_version, or
+        None for the current one (default: None)
+    :type version: Optional[tuple]
+    :raises error.API: the survey has no data
+    :return: A context manager giving the connection
+    :rtype: Iterator[sqlite3.Connection]
+    """
+
+    if version is None:
+        version = get_data_version(survey)
+    if version == (survey.id, None):
+        raise error.API('no data')
+    conn = pool.SURVEYS.acquire(survey.id, version)
+    try:
+        yield conn
+    finally:
+        pool.SURVEYS.release(survey.id, version, conn)
+
+
+def get_data_version(survey: Survey) -> tuple:
+    """Get the version of the survey data. It changes every time the
+    database of the survey is written to, also by other processes.
+
+    :param survey: The survey
+    :type survey: Survey
+    :return: A hashable version identifier, unique among surveys, which is
+        (survey.id, None) if the survey has no data file
+    :rtype: tuple
+    """
+
+    try:
+        st = os.stat(f"data/{survey.id}.db")
+    except OSError:
+        return (survey.id, None)
+    return (survey.id, st.st_mtime_ns, st.st_size, st.st_ino)
+
+
 def get_answers(survey_id: int) -> Dict:
     """Get answers for given survey
 
     :param survey_id: Id of the survey
     :type survey: Survey
-    :return: Answers in the survey
+    :return: Answers in the survey, which must not be modified
     :rtype: Dict
     """
 
-    xml = ET.parse(os.path.join(ABSOLUTE_DIR_PATH, f"survey/{survey_id}.xml"))
-    result = {}
-    questions = ['single', 'multi', 'groupedsingle']
-    for q in questions:
-        for b in xml.getroot().iter(q):
-            header = b.find('header').text
-            header = re.sub('</?\w[^>]*>', '', header).strip(' \n')
-            if header not in result:
-                result[header]={}
-                result[header]["question"]=header
-                result[header]["type"]=q
-                result[header]["sub_questions"]=[]
-                result[header]["values"]={}
-
-            if 'defaultValue' in b.attrib:
-                result[header]["values"][b.attrib['defaultValue']]="default"
-            if q == 'groupedsingle':
-                for item in b.find('items'):
-                    result[header]["sub_questions"].append(item.attrib['value'].strip(' '))
-            if q != "multi":
-                for item in b.find('answers'):
-                    result[header]["values"][item.attrib['code']]=item.attrib['value'].strip(' ')
-            else:
-                for item in b.find('answers'):
-                    result[header]["sub_questions"].append(item.attrib['value'].strip(' '))
-                result[header]["values"]["0"] = "NIE"
-                result[header]["values"]["1"] = "TAK"
-    return result
+    def read(xml):
+        result = {}
+        questions = ['single', 'multi', 'groupedsingle']
+        for q in questions:
+            for b in xml.getroot().iter(q):
+                header = b.find('header').text
+                header = re.sub('</?\w[^>]*>', '', header).strip(' \n')
+                if header not in result:
+                    result[header]={}
+                    result[header]["question"]=header
+                    result[header]["type"]=q
+                    result[header]["sub_questions"]=[]
+                    result[header]["values"]={}
+
+                if 'defaultValue' in b.attrib:
+                    result[header]["values"][b.attrib['defaultValue']]="default"
+                if q == 'groupedsingle':
+                    for item in b.find('items'):
+                        result[header]["sub_questions"].append(item.attrib['value'].strip(' '))
+                if q != "multi":
+                    for item in b.find('answers'):
+                        result[header]["values"][item.attrib['code']]=item.attrib['value'].strip(' ')
+                else:
+                    for item in b.find('answers'):
+                        result[header]["sub_questions"].append(item.attrib['value'].strip(' '))
+                    result[header]["values"]["0"] = "NIE"
+                    result[header]["values"]["1"] = "TAK"
+        return result
+
+    return definitions.load(survey_id).get('answers', read)
 
 
 def get_dashboard() -> Dict:
@@ -802,48 +1200,104 @@ def get_dashboard() -> Dict:
     :rtype: Dict
     """
 
+    # Authors and permissions of all objects are loaded in bulk, with a
+    # fixed number of queries
     user = get_user()
-    user_surveys = get_user_surveys(user)
+    user_surveys = query_user_surveys(user).options(
+        selectinload(Survey.Author),
+        selectinload(Survey.Permissions)
+    ).all()
     result = []
     for survey in user_surveys:
-        author = get_user(survey.AuthorId)
+        author = survey.Author
         result.append({
             'type': 'survey',
             'endsOn': survey.EndsOn.timestamp() if survey.EndsOn is not None else None,
             'startedOn': survey.StartedOn.timestamp() if survey.StartedOn is not None else None,
             'id': survey.id,
             'name': survey.Name,
-            'sharedTo': get_survey_users(survey),
+            'sharedTo': {p.UserId: p.Type for p in survey.Permissions},
             'ankieterId': survey.AnkieterId,
             'isActive': survey.IsActive,
             'questionCount': survey.QuestionCount,
             'backgroundImg': survey.BackgroundImg,
             'userId': user.id,
-            'answersCount': get_answers_count(survey),
-            'authorId': author.id,
-            'authorName':author.CasLogin
+            'answersCount': survey.AnswersCount or 0,
+            'authorId': author.id if author else None,
+            'authorName': author.CasLogin if author else None
         })
-    user_reports = get_user_reports(user)
+    user_reports = query_user_reports(user).options(
+        selectinload(Report.ConnectedSurvey),
+        selectinload(Report.Author),
+        selectinload(Report.Permissions)
+    ).all()
     for report in user_reports:
-        try:
-            survey = get_survey(report.SurveyId)
-        except:
+        survey = report.ConnectedSurvey
+        if survey is None:
             continue
-        author = get_user(report.AuthorId)
+        author = report.Author
         result.append({
             'type': 'report',
             'id': report.id,
             'name': report.Name,
-            'sharedTo': get_report_users(report),
+            'sharedTo': {p.UserId: p.Type for p in report.Permissions},
             'connectedSurvey': {"id": report.SurveyId, "name": survey.Name},
             'backgroundImg': report.BackgroundImg,
             'userId': user.id,
-            'authorId': author.id,
-            'authorName': author.CasLogin
+            'authorId': author.id if author else None,
+            'authorName': author.CasLogin if author else None
         })
     return {"objects": result}
 
 
+class Schema:
+    """Columns of the data of a survey, in the order of the database"""
+
+    def __init__(self, types: Dict[str, str]):
+        self.types = types #: SQL types of the columns, by name
+        self.columns = list(types) #: Names of the columns
+
+
+def get_schema(conn: sqlite3.Connection, version: Optional[tuple] = None) -> Schema:
+    """Get the schema of a survey database, cached for its data version.
+
+    :param conn: Connection to the database
+    :type conn: sqlite3.Connection
+    :param version: Data version of the database, as returned from
+        get_data_version, or None not to use the cache (default: None)
+    :type version: Optional[tuple]
+    :return: The schema, which must not be modified
+    :rtype: Schema
+    """
+
+    schema = SCHEMAS.get(version) if version is not None else None
+    if schema is None:
+        schema = Schema(get_types(conn))
+        if version is not None:
+            SCHEMAS.put(version, schema)
+    return schema
+
+
+def get_survey_schema(survey: Survey) -> Schema:
+    """Get the schema of the current data of a survey, opening its database
+    only if the schema isn't cached. A survey without data has no columns.
+
+    :param survey: The survey
+    :type survey: Survey
+    :return: The schema, which must not be modified
+    :rtype: Schema
+    """
+
+    version = get_data_version(survey)
+    if version == (survey.id, None):
+        return Schema({})
+    schema = SCHEMAS.get(version)
+    if schema is None:
+        with read_survey(survey, version) as conn:
+            schema = get_schema(conn, version)
+    return schema
+
+
 def get_types(conn: sqlite3.Connection) -> Dict[str, str]:
     """Get types for each column in the database.
 
@@ -880,8 +1334,8 @@ def get_columns(conn: sqlite3.Connection) -> List[str]:
     return columns
 
 
-def get_answers_count(survey: Survey) -> int:
-    """Get number of answers in the database for a given survey.
+def count_answers(survey: Survey) -> int:
+    """Count answers in the database of a given survey.
 
     :param survey: The survey
     :type survey: Survey
@@ -892,9 +1346,234 @@ def get_answers_count(survey: Survey) -> int:
     conn = open_survey(survey)
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM data")
-        n = len(cur.fetchall())
+        cur.execute("SELECT COUNT(*) FROM data")
+        n = cur.fetchone()[0]
     except:
         n = 0
     conn.close()
     return n
+
+
+def get_answers_count(survey: Survey) -> int:
+    """Get number of answers in the database for a given survey, as saved
+    when the data was written.
+
+    :param survey: The survey
+    :type survey: Survey
+    :return: The number of answers
+    :rtype: int
+    """
+
+    if survey.AnswersCount is None:
+        set_answers_count(survey, count_answers(survey))
+    return survey.AnswersCount
+
+
+def set_answers_count(survey: Survey, count: int):
+    """Save the number of answers in the database of a given survey.
+
+    :param survey: The survey
+    :type survey: Survey
+    :param count: The number of answers
+    :type count: int
+    """
+
+    survey.AnswersCount = count
+    db.session.commit()
+
+
+def migrate():
+    """Update tables of an existing master.db to the models. Missing tables
+    and columns are created, and new columns are filled in. Missing indexes
+    are created separately, by create_indexes.
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = set()
+    for table in db.metadata.sorted_tables:
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                sqltype = column.type.compile(db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {sqltype}'))
+                added.add((table.name, column.name))
+    db.session.commit()
+
+    if ('Surveys', 'AnswersCount') in added:
+        for survey in Survey.query.all():
+            survey.AnswersCount = count_answers(survey)
+        db.session.commit()
+    if ('Users', 'Login') in added:
+        for user in User.query.all():
+            user.Login = user.CasLogin.split('@')[0]
+        db.session.commit()
+
+
+def create_indexes() -> List[str]:
+    """Create indexes of the models missing from an existing master.db.
+
+    :return: Names of the created indexes
+    :rtype: List[str]
+    """
+
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+    return created
+
+
+def create_job(survey: Survey, user: User, filename: str, defaults: Dict) -> Job:
+    """Queue saving an uploaded file to the survey database.
+
+    :param survey: The survey
+    :type survey: Survey
+    :param user: The user who uploaded the file
+    :type user: User
+    :param filename: Name of the file in the raw/ directory
+    :type filename: str
+    :param defaults: A dict with default values set for each column name
+    :type defaults: Dict
+    :raises error.API: the survey data is already being saved
+    :return: The queued job
+    :rtype: Job
+    """
+
+    # A job is queued only if the survey has no queued or running one, and
+    # both are done by the same statement, so that concurrent uploads of a
+    # survey can't queue two jobs
+    now = datetime.now()
+    defaults = json.dumps({k: sorted(v) for k, v in defaults.items()})
+    pending = db.session.query(Job.id).filter(Job.SurveyId == survey.id, Job.State.in_(['queued', 'running'])).exists()
+    values = db.select(
+        db.literal(survey.id, db.Integer),
+        db.literal(user.id, db.Integer),
+        db.literal(filename, db.String),
+        db.literal(defaults, db.String),
+        db.literal(now, db.DateTime),
+        db.literal(now, db.DateTime),
+    ).where(~pending)
+    columns = ['SurveyId', 'UserId', 'Filename', 'Defaults', 'CreatedOn', 'UpdatedOn']
+    result = db.session.execute(insert(Job.__table__).from_select(columns, values))
+    db.session.commit()
+    if result.rowcount == 0:
+        raise error.API('the survey data is already being saved')
+    return Job.query.get(result.lastrowid)
+
+
+def get_job(job_id: int) -> Job:
+    """Get job by given id.
+
+    :param job_id: Job's id
+    :type job_id: int
+    :raises error.API: no such job
+    :return: The job
+    :rtype: Job
+    """
+
+    job = Job.query.filter_by(id=job_id).first()
+    if job is None:
+        raise error.API('no such job')
+    return job
+
+
+def get_job_defaults(job: Job) -> Dict:
+    """Get default values the data of the job is converted with.
+
+    :param job: The job
+    :type job: Job
+    :return: A dict with default values set for each column name
+    :rtype: Dict
+    """
+
+    return {k: set(v) for k, v in json.loads(job.Defaults).items()}
+
+
+def get_pending_job(survey: Survey) -> Optional[Job]:
+    """Get a queued or running job of the survey.
+
+    :param survey: The survey
+    :type survey: Survey
+    :return: The job, or None if all jobs of the survey are finished
+    :rtype: Optional[Job]
+    """
+
+    return Job.query.filter(Job.SurveyId == survey.id, Job.State.in_(['queued', 'running'])).first()
+
+
+def claim_job() -> Optional[Job]:
+    """Start the oldest queued job, unless a job of the same survey is
+    running. A job can be claimed only once, also if many processes try,
+    and both conditions are checked by the update that starts it.
+
+    :return: The started job, or None if there is none to start
+    :rtype: Optional[Job]
+    """
+
+    running = db.session.query(Job.SurveyId).filter_by(State='running')
+    other = db.aliased(Job)
+    busy = db.session.query(other.id).filter(other.SurveyId == Job.SurveyId, other.State == 'running').exists()
+    while True:
+        job = Job.query.filter(Job.State == 'queued', Job.SurveyId.notin_(running)).order_by(Job.id).first()
+        if job is None:
+            db.session.commit()
+            return None
+        claimable = Job.query.filter(Job.id == job.id, Job.State == 'queued', ~busy)
+        claimed = claimable.update({'State': 'running', 'UpdatedOn': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job
+
+
+def recover_jobs(timeout: float) -> int:
+    """Mark running jobs as failed if their progress didn't change for too
+    long, because the process running them was killed or restarted. Queued
+    jobs of their surveys can be started then.
+
+    :param timeout: Number of seconds after which a running job is failed
+    :type timeout: float
+    :return: The number of failed jobs
+    :rtype: int
+    """
+
+    now = datetime.now()
+    stale = Job.query.filter(Job.State == 'running', Job.UpdatedOn < now - timedelta(seconds=timeout))
+    failed = stale.update({'State': 'failed', 'Error': 'the job was interrupted', 'UpdatedOn': now}, synchronize_session=False)
+    db.session.commit()
+    return failed
+
+
+def set_job_progress(job: Job, stage: str, percent: int):
+    """Save the progress of a stage of a running job.
+
+    :param job: The job
+    :type job: Job
+    :param stage: The stage, parse, compact or write
+    :type stage: str
+    :param percent: Percentage of the stage done
+    :type percent: int
+    """
+
+    setattr(job, stage.capitalize(), percent)
+    job.UpdatedOn = datetime.now()
+    db.session.commit()
+
+
+def finish_job(job: Job, err: Optional[str] = None):
+    """Mark a job as done, or as failed if an error message is given.
+
+    :param job: The job
+    :type job: Job
+    :param err: Why the job failed (default: None)
+    :type err: Optional[str]
+    """
+
+    job.State = 'done' if err is None else 'failed'
+    job.Error = err
+    job.UpdatedOn = datetime.now()
+    db.session.commit()
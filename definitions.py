@@ -0,0 +1,72 @@
+from typing import Any, Callable
+import xml.etree.ElementTree as ET
+import cache
+import os
+
+# Parsed survey definitions, by survey id and the modification time and size
+# of the XML file
+CACHE = cache.LRU(128)
+
+
+def path(survey_id: int) -> str:
+    """Get the path of the XML definition of a survey.
+
+    :param survey_id: Id of the survey
+    :type survey_id: int
+    :return: The path to the file
+    :rtype: str
+    """
+
+    return f"survey/{survey_id}.xml"
+
+
+def load(survey_id: int) -> 'Definition':
+    """Get the parsed XML definition of a survey. The file is parsed again
+    only when it changes.
+
+    :param survey_id: Id of the survey
+    :type survey_id: int
+    :return: The definition
+    :rtype: Definition
+    """
+
+    st = os.stat(path(survey_id))
+    key = (survey_id, st.st_mtime_ns, st.st_size)
+    definition = CACHE.get(key)
+    if definition is None:
+        definition = Definition(ET.parse(path(survey_id)))
+        invalidate(survey_id)
+        CACHE.put(key, definition)
+    return definition
+
+
+def invalidate(survey_id: int):
+    """Forget the parsed definition of a survey, after its file is written.
+
+    :param survey_id: Id of the survey
+    :type survey_id: int
+    """
+
+    CACHE.invalidate(lambda key: key[0] == survey_id)
+
+
+class Definition:
+    """A parsed XML definition of a survey, with values read from it"""
+
+    def __init__(self, xml: ET.ElementTree):
+        self.xml = xml
+        self.values = {}
+
+    def get(self, name: str, read: Callable[[ET.ElementTree], Any]) -> Any:
+        """Get a value read from the definition, reading it only once.
+
+        :param name: Name of the value
+        :type name: str
+        :param read: A function reading the value from the parsed XML
+        :type read: Callable[[ET.ElementTree], Any]
+        :return: The value, which must not be modified
+        """
+
+        if name not in self.values:
+            self.values[name] = read(self.xml)
+        return self.values[name]
@@ -49,6 +49,66 @@ try:
         DEBUG = config.DEBUG
     else:
         DEBUG = False
+
+    if 'TABLE_CACHE_ENTRIES' in keys:
+        TABLE_CACHE_ENTRIES = config.TABLE_CACHE_ENTRIES
+    else:
+        TABLE_CACHE_ENTRIES = 1024
+
+    if 'TABLE_CACHE_SIZE' in keys:
+        TABLE_CACHE_SIZE = config.TABLE_CACHE_SIZE
+    else:
+        TABLE_CACHE_SIZE = 64*1024*1024
+
+    if 'CSV_CHUNK_ROWS' in keys:
+        CSV_CHUNK_ROWS = config.CSV_CHUNK_ROWS
+    else:
+        CSV_CHUNK_ROWS = 10000
+
+    if 'JOB_WORKERS' in keys:
+        JOB_WORKERS = config.JOB_WORKERS
+    else:
+        JOB_WORKERS = 2
+
+    if 'JOB_POLL_INTERVAL' in keys:
+        JOB_POLL_INTERVAL = config.JOB_POLL_INTERVAL
+    else:
+        JOB_POLL_INTERVAL = 5
+
+    if 'JOB_TIMEOUT' in keys:
+        JOB_TIMEOUT = config.JOB_TIMEOUT
+    else:
+        JOB_TIMEOUT = 30*60
+
+    if 'SURVEY_POOL_SIZE' in keys:
+        SURVEY_POOL_SIZE = config.SURVEY_POOL_SIZE
+    else:
+        SURVEY_POOL_SIZE = 32
+
+    if 'SURVEY_POOL_IDLE' in keys:
+        SURVEY_POOL_IDLE = config.SURVEY_POOL_IDLE
+    else:
+        SURVEY_POOL_IDLE = 60
+
+    if 'SURVEY_MMAP_SIZE' in keys:
+        SURVEY_MMAP_SIZE = config.SURVEY_MMAP_SIZE
+    else:
+        SURVEY_MMAP_SIZE = 256*1024*1024
+
+    if 'SURVEY_CACHE_SIZE' in keys:
+        SURVEY_CACHE_SIZE = config.SURVEY_CACHE_SIZE
+    else:
+        SURVEY_CACHE_SIZE = 8*1024*1024
+
+    if 'DATABASE_TIMEOUT' in keys:
+        DATABASE_TIMEOUT = config.DATABASE_TIMEOUT
+    else:
+        DATABASE_TIMEOUT = 30
+
+    if 'SLOW_QUERY_TIME' in keys:
+        SLOW_QUERY_TIME = config.SLOW_QUERY_TIME
+    else:
+        SLOW_QUERY_TIME = None
 except:
     print('config.py incorrect or not present: running default debug config')
     CAS_URL= ''
@@ -61,6 +121,18 @@ except:
     DAEMONS_INTERVAL = 5*60
     LOCALHOST = True
     DEBUG = True
+    TABLE_CACHE_ENTRIES = 1024
+    TABLE_CACHE_SIZE = 64*1024*1024
+    CSV_CHUNK_ROWS = 10000
+    JOB_WORKERS = 2
+    JOB_POLL_INTERVAL = 5
+    JOB_TIMEOUT = 30*60
+    SURVEY_POOL_SIZE = 32
+    SURVEY_POOL_IDLE = 60
+    SURVEY_MMAP_SIZE = 256*1024*1024
+    SURVEY_CACHE_SIZE = 8*1024*1024
+    DATABASE_TIMEOUT = 30
+    SLOW_QUERY_TIME = None
 
 SALT_LENGTH=22
 
@@ -3,3 +3,13 @@ from globals import SSL_CONTEXT
 if len(SSL_CONTEXT) > 1:
     certfile=SSL_CONTEXT[0]
     keyfile=SSL_CONTEXT[1]
+
+
+def on_starting(server):
+    # Update master.db once, before the workers are started, instead of in
+    # every worker on its first request
+    import database
+    with database.app.app_context():
+        database.migrate()
+        database.create_indexes()
+    database.db.engine.dispose()
@@ -0,0 +1,87 @@
+from globals import *
+import threading
+import database
+import convert
+import daemon
+import error
+import os
+
+# Notified when a job is queued, so that workers of this process don't
+# wait for the next poll. Jobs queued by other processes are found by
+# polling the database every JOB_POLL_INTERVAL seconds.
+QUEUED = threading.Condition()
+
+
+def submit(survey: database.Survey, user: database.User, filename: str, defaults: dict) -> database.Job:
+    """Queue saving an uploaded file to the survey database.
+
+    :param survey: The survey
+    :type survey: database.Survey
+    :param user: The user who uploaded the file
+    :type user: database.User
+    :param filename: Name of the file in the raw/ directory
+    :type filename: str
+    :param defaults: A dict with default values set for each column name
+    :type defaults: dict
+    :raises error.API: the survey data is already being saved
+    :return: The queued job
+    :rtype: database.Job
+    """
+
+    job = database.create_job(survey, user, filename, defaults)
+    with QUEUED:
+        QUEUED.notify()
+    return job
+
+
+def run(job: database.Job):
+    """Save the file of a started job to the survey database, reporting the
+    progress, and mark the job as done or failed. The file is removed then.
+
+    :param job: The job, claimed with database.claim_job
+    :type job: database.Job
+    """
+
+    try:
+        survey = database.get_survey(job.SurveyId)
+        report = lambda stage, percent: database.set_job_progress(job, stage, percent)
+        convert.csv_to_db(survey, job.Filename, database.get_job_defaults(job), report)
+        conn = database.open_survey(survey)
+        survey.QuestionCount = len(database.get_columns(conn))
+        conn.close()
+    except error.API as err:
+        database.db.session.rollback()
+        database.finish_job(job, err.message)
+    except Exception as err:
+        database.db.session.rollback()
+        database.finish_job(job, str(err))
+    else:
+        database.finish_job(job)
+    finally:
+        if os.path.exists(f'raw/{job.Filename}'):
+            os.remove(f'raw/{job.Filename}')
+
+
+def work():
+    """Run queued jobs one by one, waiting for new ones when there are none.
+    Jobs left running by a killed process are failed after JOB_TIMEOUT
+    seconds.
+    """
+
+    while True:
+        job = None
+        with app.app_context():
+            try:
+                database.recover_jobs(JOB_TIMEOUT)
+                job = database.claim_job()
+                if job is not None:
+                    run(job)
+            except Exception as err:
+                log(f'could not run job: {err}')
+        if job is None:
+            with QUEUED:
+                QUEUED.wait(JOB_POLL_INTERVAL)
+
+
+for _ in range(JOB_WORKERS):
+    daemon.daemon(work)
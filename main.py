@@ -2,16 +2,19 @@
 
 from flask import send_from_directory, redirect, url_for, request, session, g, render_template, send_file
 from os.path import exists
+from uuid import uuid4
 from globals import *
 import json
 import os
 import functools
-import threading
 import database
 import convert
 import grammar
 import daemon
 import table
+import jobs
+import pool
+import definitions
 import error
 
 
@@ -42,6 +45,44 @@ def for_roles(*roles):
     return for_roles_decorator
 
 
+def create_tables(survey: database.Survey, queries, many: bool):
+    """Create tables of survey data. They are profiled if the request has
+    the profile argument, or if slow queries are logged (SLOW_QUERY_TIME).
+
+    :param survey: The survey
+    :type survey: database.Survey
+    :param queries: A query, or a list of queries if many is set
+    :param many: Whether to create many tables with table.create_many
+    :type many: bool
+    :return: The table or the list of tables, and the profile if it was
+        requested or None
+    :rtype: tuple
+    """
+
+    requested = 'profile' in request.args
+    profile = None
+    if requested or SLOW_QUERY_TIME is not None:
+        # Only stages are timed for the log of slow queries
+        profile = table.Profile(detailed=requested)
+
+    # The same version picks the connection and caches the tables, so that
+    # tables of replaced data are never cached under the new version
+    create = table.create_many if many else table.create
+    version = database.get_data_version(survey)
+    with database.read_survey(survey, version) as conn:
+        result = create(queries, conn, version, profile)
+
+    if profile is not None and SLOW_QUERY_TIME is not None and profile.time >= SLOW_QUERY_TIME:
+        app.logger.warning(f'slow query of survey {survey.id} took {profile.time:.3f}s: '
+                           f'{json.dumps(queries)}, profile: {json.dumps(profile.as_dict())}')
+    return result, profile if requested else None
+
+
+@app.before_first_request
+def start_daemons():
+    daemon.start()
+
+
 @app.route('/api/dashboard', methods=['GET'])
 @on_errors('could not get dashboard')
 @for_roles('s', 'u', 'g')
@@ -252,6 +293,7 @@ def upload_survey(survey_id):
         if not file.filename.endswith('.xml'):
             raise error.API('expected an XML file')
         file.save(f'survey/{survey.id}.xml')
+        definitions.invalidate(survey.id)
     else:
         convert.json_to_xml(survey, request.json)
 
@@ -332,9 +374,8 @@ def share_survey(survey_id):
     perm = database.get_survey_permission(survey, database.get_user())
     if perm != 'o':
         raise error.API("you must be the owner to share this survey")
-    for p, users in json.items():
-        for user in users:
-            database.set_survey_permission(survey, database.get_user(user), p)
+    permissions = [(user, p) for p, users in json.items() for user in database.get_users(users)]
+    database.set_survey_permissions(survey, permissions)
     return {
         "message": "permissions added"
     }
@@ -577,9 +618,8 @@ def share_report(report_id):
     perm = database.get_report_permission(report, database.get_user())
     if perm != 'o':
         raise error.API("only the owner can share a report")
-    for p, users in json.items():
-        for user in users:
-            database.set_report_permission(report, database.get_user(user), p)
+    permissions = [(user, p) for p, users in json.items() for user in database.get_users(users)]
+    database.set_report_permissions(report, permissions)
     return {
         "message": "permissions added"
     }
@@ -656,6 +696,8 @@ def get_report_data(report_id):
     :Methods: POST
     :Roles: s, u, g
     :param int report_id: Report's id
+    :param profile: (query string) if present, a profile of creating the
+        table is returned under 'profile'
     :return: Parsed data
     :rtype: Dict
     """
@@ -669,10 +711,46 @@ def get_report_data(report_id):
 
     survey = database.get_report_survey(report)
 
-    conn = database.open_survey(survey)
-    result = table.create(request.json, conn)
-    conn.close()
+    result, profile = create_tables(survey, request.json, many=False)
+    if profile is not None:
+        # The table may be cached, so it's copied instead of modified
+        result = dict(result, profile=profile.as_dict())
+    return result
+
+
+@app.route('/api/report/<int:report_id>/data/batch', methods=['POST'])
+@on_errors('could not obtain survey data for the report')
+@for_roles('s', 'u', 'g')
+def get_report_data_batch(report_id):
+    """Get data for many charts at once
+
+    :Route: /api/report/<int:report_id>/data/batch
+    :Methods: POST
+    :Roles: s, u, g
+    :param int report_id: Report's id
+    :param profile: (query string) if present, a profile of creating the
+        tables is returned under 'profile'
+    :return: {'results': [parsed data or {'error': message}, ...]}
+    :rtype: Dict
+    """
+
+    grammar.check([dict], request.json)
 
+    report = database.get_report(report_id)
+    user = database.get_user()
+
+    perm = database.get_report_permission(report, user)
+    if perm not in ['r', 'w', 'o']:
+        raise error.API('insufficient permissions')
+
+    survey = database.get_report_survey(report)
+
+    results, profile = create_tables(survey, request.json, many=True)
+    result = {
+        'results': [r.as_dict() if isinstance(r, error.API) else r for r in results]
+    }
+    if profile is not None:
+        result['profile'] = profile.as_dict()
     return result
 
 
@@ -828,11 +906,11 @@ def set_group():
     :rtype: Dict
     """
 
+    groups = {}
     for group, ids in request.json.items():
         grammar.check([int], ids)
-        for id in ids:
-            user = database.get_user(id)
-            database.set_user_group(user, group)
+        groups[group] = database.get_users(ids)
+    database.set_users_groups(groups)
     return {
         'message': 'users added to groups'
     }
@@ -852,11 +930,11 @@ def unset_group():
     :rtype: Dict
     """
 
+    groups = {}
     for group, ids in request.json.items():
         grammar.check([int], ids)
-        for id in ids:
-            user = database.get_user(id)
-            database.unset_user_group(user, group)
+        groups[group] = database.get_users(ids)
+    database.unset_users_groups(groups)
     return {
         'message': 'users removed from groups'
     }
@@ -875,12 +953,7 @@ def get_groups():
     :rtype: Dict
     """
 
-    result = {}
-    for group in database.get_groups():
-        result[group] = []
-        for user in database.get_group_users(group):
-            result[group].append(user.as_dict())
-    return result
+    return database.get_all_groups()
 
 
 # {'group': 'nazwa grupy'}
@@ -918,7 +991,8 @@ def upload_results(survey_id):
     :Methods: POST
     :Roles: s, u
     :param int survey_id: Survey's id
-    :return: {"id": survey.id,"name": name}
+    :return: {"id": survey.id, "name": name, "job": job.id}, the data is saved
+        by the job in the background
     :rtype: Dict
     """
 
@@ -942,19 +1016,52 @@ def upload_results(survey_id):
         survey = database.create_survey(user, name)
         defaults = {}
 
-    file.save(f"raw/{survey.id}.{ext}")
-
-    convert.csv_to_db(survey, f"{survey.id}.{ext}", defaults)
-    conn = database.open_survey(survey)
-    survey.QuestionCount = len(database.get_columns(conn))
-    conn.close()
+    # Every upload is saved under its own name, so that it can't replace
+    # the file of a job that is queued or running
+    filename = f"{survey.id}.{uuid4().hex}.{ext}"
+    file.save(f"raw/{filename}")
+    try:
+        job = jobs.submit(survey, user, filename, defaults)
+    except error.API:
+        os.remove(f"raw/{filename}")
+        raise
 
     return {
         "id": survey.id,
-        "name": name
+        "name": name,
+        "job": job.id
     }
 
 
+@app.route('/api/job/<int:job_id>', methods=['GET'])
+@on_errors('could not get job status')
+@for_roles('s', 'u')
+def get_job(job_id):
+    """Get the state and progress of saving uploaded survey data
+
+    :Route: /api/job/<int:job_id>
+    :Methods: GET
+    :Roles: s, u
+    :param int job_id: Job's id
+    :Returns: Dict
+    :Return:
+    :param int id: job id
+    :param int surveyId: id of the survey the data is saved to
+    :param str state: queued, running, done or failed
+    :param dict progress: {stage: percent} for stages parse, compact and write
+    :param str error: why the job failed, null otherwise
+    :param timestamp createdOn: when the job was queued
+    :param timestamp updatedOn: when the job last changed
+    """
+
+    job = database.get_job(job_id)
+    survey = database.get_survey(job.SurveyId)
+    perm = database.get_survey_permission(survey, database.get_user())
+    if perm not in ['r', 'w', 'o']:
+        raise error.API('no access to the survey')
+    return job.as_dict()
+
+
 @app.route('/api/data/<int:survey_id>/download', methods=['GET'])
 @on_errors('could not download survey csv')
 @for_roles('s', 'u')
@@ -1002,10 +1109,7 @@ def get_data_types(survey_id):
     if perm not in ['r', 'w', 'o']:
         raise error.API('no access to the survey')
 
-    conn = database.open_survey(survey)
-    types = database.get_types(conn)
-    conn.close()
-    return types
+    return dict(database.get_survey_schema(survey).types)
 
 
 @app.route('/api/data/<int:survey_id>/questions', methods=['GET'])
@@ -1029,11 +1133,8 @@ def get_questions(survey_id):
     if perm not in ['r', 'w', 'o']:
         raise error.API('no access to the survey')
 
-    conn = database.open_survey(survey)
-    questions = database.get_columns(conn)
-    conn.close()
     return {
-        'questions': questions
+        'questions': list(database.get_survey_schema(survey).columns)
     }
 
 
@@ -1047,6 +1148,8 @@ def get_data(survey_id):
     :Methods: POST
     :Roles: s, u, g
     :param int survey_id: Survey's id
+    :param profile: (query string) if present, a profile of creating the
+        table is returned under 'profile'
     :return:
     :rtype: Dict
     """
@@ -1058,12 +1161,67 @@ def get_data(survey_id):
     if perm not in ['r', 'w', 'o']:
         raise error.API('no access to the survey')
 
-    conn = database.open_survey(survey)
-    result = table.create(request.json, conn)
-    conn.close()
+    result, profile = create_tables(survey, request.json, many=False)
+    if profile is not None:
+        # The table may be cached, so it's copied instead of modified
+        result = dict(result, profile=profile.as_dict())
     return result
 
 
+@app.route('/api/data/<int:survey_id>/batch', methods=['POST'])
+@on_errors('could not obtain survey data')
+@for_roles('s', 'u', 'g')
+def get_data_batch(survey_id):
+    """Get many tables of survey data at once
+
+    :Route: /api/data/<int:survey_id>/batch
+    :Methods: POST
+    :Roles: s, u, g
+    :param int survey_id: Survey's id
+    :param profile: (query string) if present, a profile of creating the
+        tables is returned under 'profile'
+    :return: {'results': [data or {'error': message}, ...]}
+    :rtype: Dict
+    """
+
+    grammar.check([dict], request.json)
+
+    survey = database.get_survey(survey_id)
+    user = database.get_user()
+
+    perm = database.get_survey_permission(survey, user)
+    if perm not in ['r', 'w', 'o']:
+        raise error.API('no access to the survey')
+
+    results, profile = create_tables(survey, request.json, many=True)
+    result = {
+        'results': [r.as_dict() if isinstance(r, error.API) else r for r in results]
+    }
+    if profile is not None:
+        result['profile'] = profile.as_dict()
+    return result
+
+
+@app.route('/api/cache', methods=['GET'])
+@on_errors('could not get cache statistics')
+@for_roles('s')
+def get_cache_stats():
+    """Get usage statistics of the server caches
+
+    :Route: /api/cache
+    :Methods: GET
+    :Roles: s
+    :return: {'table': {'entries': int, 'size': int, 'hits': int, 'misses': int},
+        'connections': {'idle': int, 'hits': int, 'misses': int}}
+    :rtype: Dict
+    """
+
+    return {
+        'table': table.CACHE.stats(),
+        'connections': pool.SURVEYS.stats()
+    }
+
+
 @app.route('/api/link/<hash>', methods=['GET'])
 @on_errors('could not set permission link')
 @for_roles('s', 'u', 'g') # to be tested for 'g'
@@ -1190,8 +1348,10 @@ if __name__ == '__main__':
         print('debug mode on: accounts can be accessed WITHOUT password')
     print('starting deamon threads')
 
-    for d in daemon.LIST:
-        threading.Thread(target=d, daemon=True).start()
+    with app.app_context():
+        database.migrate()
+        database.create_indexes()
+    daemon.start()
 
     if LOCALHOST:
         print(f'the app is hosted on localhost:{APP_PORT}')
@@ -0,0 +1,153 @@
+from typing import Callable, Hashable
+from globals import *
+import threading
+import sqlite3
+import daemon
+import time
+
+
+class Pool:
+    """A thread-safe pool of connections. Connections are kept by a key and
+    the version of the data they were opened for, and are reused only for
+    the same version. Idle connections are closed when there are too many
+    of them, or when they aren't used for too long.
+    """
+
+    def __init__(self, connect: Callable[[Hashable], sqlite3.Connection], size: int, idle: float):
+        """Create an empty pool.
+
+        :param connect: A function opening a new connection for a key
+        :type connect: Callable[[Hashable], sqlite3.Connection]
+        :param size: Maximal number of idle connections (0 disables the pool)
+        :type size: int
+        :param idle: Number of seconds after which idle connections are closed
+        :type idle: float
+        """
+
+        self.connect = connect
+        self.size = size
+        self.idle = idle
+        self.hits = 0
+        self.misses = 0
+        self.free = [] # (key, version, connection, release time), the oldest first
+        self.lock = threading.Lock()
+
+    def acquire(self, key: Hashable, version: Hashable) -> sqlite3.Connection:
+        """Take an idle connection for the version of the data, or open a new
+        one. Idle connections to other versions of the data are closed.
+
+        :param key: The key of the connection
+        :type key: Hashable
+        :param version: The current version of the data
+        :return: The connection, to be released when it is no longer used
+        :rtype: sqlite3.Connection
+        """
+
+        stale = []
+        conn = None
+        with self.lock:
+            for i in reversed(range(len(self.free))):
+                k, v, c, _ = self.free[i]
+                if k != key:
+                    continue
+                del self.free[i]
+                if v == version and conn is None:
+                    conn = c
+                else:
+                    stale.append(c)
+            if conn is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        for c in stale:
+            c.close()
+        if conn is None:
+            conn = self.connect(key)
+        return conn
+
+    def release(self, key: Hashable, version: Hashable, conn: sqlite3.Connection):
+        """Give back a connection taken with acquire.
+
+        :param key: The key of the connection
+        :type key: Hashable
+        :param version: The version of the data it was acquired for
+        :param conn: The connection
+        :type conn: sqlite3.Connection
+        """
+
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            self.free.append((key, version, conn, time.monotonic()))
+        self.evict()
+
+    def invalidate(self, key: Hashable):
+        """Close idle connections for a key, for example after the data was
+        replaced.
+
+        :param key: The key of the connections
+        :type key: Hashable
+        """
+
+        with self.lock:
+            closed = [c for k, _, c, _ in self.free if k == key]
+            self.free = [f for f in self.free if f[0] != key]
+        for c in closed:
+            c.close()
+
+    def evict(self):
+        """Close the oldest idle connections above the size of the pool and
+        connections idle for too long.
+        """
+
+        deadline = time.monotonic() - self.idle
+        with self.lock:
+            old = max(len(self.free) - self.size, 0)
+            while old < len(self.free) and self.free[old][3] < deadline:
+                old += 1
+            closed = [c for _, _, c, _ in self.free[:old]]
+            del self.free[:old]
+        for c in closed:
+            c.close()
+
+    def stats(self) -> dict:
+        """Get usage statistics of the pool.
+
+        :return: Numbers of idle connections, hits and misses
+        :rtype: dict
+        """
+
+        with self.lock:
+            return {
+                'idle':   len(self.free),
+                'hits':   self.hits,
+                'misses': self.misses,
+            }
+
+
+def connect_survey(survey_id: int) -> sqlite3.Connection:
+    """Open a read-only connection to a survey database, tuned for
+    repeated queries.
+
+    :param survey_id: Id of the survey
+    :type survey_id: int
+    :return: The connection
+    :rtype: sqlite3.Connection
+    """
+
+    conn = sqlite3.connect(f'file:data/{survey_id}.db?mode=ro', uri=True, check_same_thread=False)
+    conn.execute(f'PRAGMA mmap_size = {SURVEY_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = {-(SURVEY_CACHE_SIZE // 1024)}')
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+
+# Read-only connections to survey databases, by survey id
+SURVEYS = Pool(connect_survey, SURVEY_POOL_SIZE, SURVEY_POOL_IDLE)
+
+
+@daemon.daemon
+def evict_surveys():
+    while True:
+        time.sleep(max(SURVEY_POOL_IDLE, 1))
+        SURVEYS.evict()
@@ -80,3 +80,8 @@ if __name__ == "__main__":
         admin = ask('Nazwa użytkownika CAS, który będzie administratorem', ['admin'])
         pesel = ask('PESEL administratora (umożliwi logowanie na dwa sposoby)', [99999999999])
         setup(admin=admin, pesel=pesel)
+    else:
+        migrate()
+        print("Zaktualizowano bazę danych użytkowników")
+        for index in create_indexes():
+            print(f"Utworzono indeks {index}")
@@ -0,0 +1,288 @@
+from typing import Iterable, Optional
+import pandas
+import numpy
+import shutil
+import sqlite3
+import database
+import cache
+import json
+import os
+
+# Opened stores, by data version
+OPEN = cache.LRU(64)
+
+# Number of rows fetched at once while building a store
+BATCH_ROWS = 10000
+
+
+def path(survey_id: int) -> str:
+    """Get the directory of the columnar store of a survey.
+
+    :param survey_id: Id of the survey
+    :type survey_id: int
+    :return: The path to the directory
+    :rtype: str
+    """
+
+    return f"data/{survey_id}.columns"
+
+
+def build(survey: database.Survey):
+    """Save every column of the survey data to a separate, memory mappable
+    file. The survey database stays the source of truth: the store is used
+    only as long as the database is not changed, so it has to be rebuilt
+    every time the data is written.
+
+    :param survey: The survey
+    :type survey: database.Survey
+    """
+
+    version = database.get_data_version(survey)
+    conn = database.open_survey(survey)
+    tmp = f'{path(survey.id)}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        manifest = save_columns(conn, tmp)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+    manifest['version'] = list(version)
+
+    # Don't publish a store of data that changed while it was being read
+    if database.get_data_version(survey) != version:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    with open(f'{tmp}/manifest.json', 'w') as file:
+        json.dump(manifest, file)
+    old = f'{path(survey.id)}.{os.getpid()}.old'
+    if os.path.exists(path(survey.id)):
+        os.replace(path(survey.id), old)
+    os.replace(tmp, path(survey.id))
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def save_columns(conn: sqlite3.Connection, directory: str) -> dict:
+    """Save the rowids and every column of the survey data in a single pass
+    over the table, BATCH_ROWS rows at a time, so that the data never has to
+    fit in memory.
+
+    :param conn: Connection to the survey database
+    :type conn: sqlite3.Connection
+    :param directory: The directory to save the files in
+    :type directory: str
+    :return: The manifest of the store, without the data version
+    :rtype: dict
+    """
+
+    # Count and read the rows in one transaction, so that they match
+    conn.execute('BEGIN')
+    try:
+        types = database.get_types(conn)
+        rows, = conn.execute('SELECT COUNT(*) FROM data').fetchone()
+        rowids = open_array(f'{directory}/rowid.npy', 'int64', rows)
+        columns = [Column(f'{directory}/{k}', sqltype, rows) for k, sqltype in enumerate(types.values())]
+        try:
+            select = ', '.join(['rowid'] + [f'"{name}"' for name in types])
+            cursor = conn.execute(f'SELECT {select} FROM data ORDER BY rowid')
+            while True:
+                batch = cursor.fetchmany(BATCH_ROWS)
+                if not batch:
+                    break
+                values = list(zip(*batch))
+                numpy.array(values[0], dtype='int64').tofile(rowids)
+                for column, vals in zip(columns, values[1:]):
+                    column.add(vals)
+        finally:
+            rowids.close()
+            saved = [column.close() for column in columns]
+    finally:
+        conn.rollback()
+    return {'rows': rows, 'columns': {name: c for name, c in zip(types, saved) if c is not None}}
+
+
+def open_array(path: str, dtype: str, rows: int):
+    """Create a .npy file of a one-dimensional array, to be filled by
+    writing its values to the returned file.
+
+    :param path: Path to the file
+    :type path: str
+    :param dtype: Type of the values
+    :type dtype: str
+    :param rows: Length of the array
+    :type rows: int
+    :return: The file, open for writing after the header
+    """
+
+    file = open(path, 'wb')
+    header = {'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), 'fortran_order': False, 'shape': (rows,)}
+    numpy.lib.format.write_array_header_1_0(file, header)
+    return file
+
+
+class Column:
+    """A column of the survey data being saved to the store, batch by batch.
+    Columns are stored only if pandas would read them with a known dtype.
+    """
+
+    kinds = {'INTEGER': int, 'REAL': float, 'TEXT': str}
+    dtypes = {'INTEGER': 'int64', 'REAL': 'float64', 'TEXT': 'int32'}
+
+    def __init__(self, prefix: str, sqltype: str, rows: int):
+        self.prefix = prefix
+        self.sqltype = sqltype
+        self.stored = sqltype in self.kinds
+        self.integral = True
+        self.categories = {}
+        if self.stored:
+            self.values = open_array(f'{prefix}.npy', self.dtypes[sqltype], rows)
+            self.mask = open_array(f'{prefix}.mask.npy', 'bool', rows)
+
+    def add(self, values: tuple):
+        """Save the next values of the column, as returned by sqlite3"""
+
+        if not self.stored:
+            return
+        kind = self.kinds[self.sqltype]
+        if any(v is not None and type(v) is not kind for v in values):
+            self.discard()
+            return
+
+        mask = numpy.array([v is None for v in values], dtype=bool)
+        mask.tofile(self.mask)
+        if self.sqltype == 'INTEGER':
+            data = numpy.array([0 if v is None else v for v in values], dtype='int64')
+        elif self.sqltype == 'REAL':
+            data = numpy.array([numpy.nan if v is None else v for v in values], dtype='float64')
+            present = data[~mask]
+            self.integral = self.integral and bool((present.astype(int) == present).all())
+        else:
+            # Categories are numbered in the order they first appear
+            codes, uniques = pandas.factorize(numpy.array(values, dtype=object))
+            numbers = numpy.array([self.categories.setdefault(u, len(self.categories)) for u in uniques] + [-1], dtype='int32')
+            data = numbers[codes]
+        data.tofile(self.values)
+
+    def discard(self):
+        """Stop saving the column and remove its files"""
+
+        self.stored = False
+        for file in (self.values, self.mask):
+            file.close()
+            os.remove(file.name)
+
+    def close(self) -> Optional[dict]:
+        """Finish saving the column.
+
+        :return: Description of the column for the manifest, or None if the
+            column can't be stored
+        :rtype: Optional[dict]
+        """
+
+        if not self.stored:
+            return None
+        self.values.close()
+        self.mask.close()
+        column = {'type': self.sqltype, 'file': os.path.basename(self.prefix)}
+        if self.sqltype == 'REAL':
+            column['integral'] = self.integral
+        if self.sqltype == 'TEXT':
+            column['categories'] = list(self.categories)
+        return column
+
+
+def load(version: tuple) -> Optional['Store']:
+    """Open the columnar store of the survey data.
+
+    :param version: Data version, as returned from database.get_data_version
+    :type version: tuple
+    :return: The store, or None if there is no store for this data version
+    :rtype: Optional[Store]
+    """
+
+    store = OPEN.get(version)
+    if store is not None:
+        return store
+
+    try:
+        with open(f'{path(version[0])}/manifest.json') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if tuple(manifest['version']) != tuple(version):
+        return None
+
+    store = Store(path(version[0]), manifest)
+    OPEN.put(version, store)
+    return store
+
+
+class Store:
+    """Memory mapped columns of the survey data"""
+
+    def __init__(self, directory: str, manifest: dict):
+        self.directory = directory
+        self.manifest = manifest
+        self.arrays = {}
+
+    def array(self, name: str) -> numpy.ndarray:
+        """Map a file of the store to memory"""
+
+        if name not in self.arrays:
+            self.arrays[name] = numpy.load(f'{self.directory}/{name}.npy', mmap_mode='r')
+        return self.arrays[name]
+
+    def has(self, columns: Iterable[str]) -> bool:
+        """Check if all of the columns are stored"""
+
+        return all(c in self.manifest['columns'] for c in columns)
+
+    def frame(self, columns: Iterable[str], rowids: Optional[list] = None) -> pandas.DataFrame:
+        """Get the columns of the data just like pandas.read_sql_query
+        followed by convert_dtypes would give them.
+
+        :param columns: Names of the columns
+        :type columns: Iterable[str]
+        :param rowids: Rowids of the selected rows in ascending order, or
+            None for all rows (default: None)
+        :type rowids: Optional[list]
+        :return: The data
+        :rtype: pandas.DataFrame
+        """
+
+        positions = None
+        if rowids is not None:
+            positions = numpy.searchsorted(self.array('rowid'), numpy.array(rowids, dtype='int64'))
+        return pandas.DataFrame({c: self.column(c, positions) for c in columns})
+
+    def column(self, name: str, positions: Optional[numpy.ndarray] = None):
+        """Get the values of a column at given positions, or all of them"""
+
+        column = self.manifest['columns'][name]
+        values = self.array(column['file'])
+        mask = self.array(f'{column["file"]}.mask')
+        if positions is not None:
+            values = values[positions]
+            mask = mask[positions]
+
+        # A column without any values is read as objects
+        if mask.all():
+            return numpy.full(len(mask), None, dtype=object)
+
+        if column['type'] == 'INTEGER':
+            return pandas.arrays.IntegerArray(values, mask)
+        if column['type'] == 'REAL':
+            # convert_dtypes makes columns of integral numbers integer
+            integral = column['integral']
+            if not integral and positions is not None:
+                present = values[~mask]
+                integral = bool((present.astype(int) == present).all())
+            if integral:
+                return pandas.arrays.IntegerArray(numpy.where(mask, 0, values).astype('int64'), mask)
+            return pandas.arrays.FloatingArray(values, mask)
+
+        categories = numpy.array(column['categories'] + [None], dtype=object)
+        return pandas.array(categories[values], dtype='string')
@@ -1,9 +1,15 @@
+from globals import TABLE_CACHE_ENTRIES, TABLE_CACHE_SIZE
+from contextlib import contextmanager, nullcontext
 import pandas
 import numpy
 import sqlite3
 import database
 import grammar
+import store
+import cache
 import error
+import json
+import time
 
 class Filter:
     def __init__(self, symbol, func, arity, *types, beg='', end='', sep=', '):
@@ -17,19 +23,120 @@ class Filter:
 
 
 class Aggregator:
-    def __init__(self, func, *types):
+    def __init__(self, func, *types, sql=None, sqltypes=None):
         self.func = func
         self.types = set(types)
+        self.sql = sql
+        self.sqltypes = set(sqltypes) if sqltypes is not None else self.types
 
 
-def filter_gt(c):  return lambda n: n if pandas.notna(n) and n > c      else pandas.NA
-def filter_lt(c):  return lambda n: n if pandas.notna(n) and n < c      else pandas.NA
-def filter_le(c):  return lambda n: n if pandas.notna(n) and n <= c     else pandas.NA
-def filter_ge(c):  return lambda n: n if pandas.notna(n) and n >= c     else pandas.NA
-def filter_eq(c):  return lambda n: n if pandas.notna(n) and n == c     else pandas.NA
-def filter_ne(c):  return lambda n: n if pandas.notna(n) and n != c     else pandas.NA
-def filter_in(*c): return lambda n: n if pandas.notna(n) and n in c     else pandas.NA
-def filter_ni(*c): return lambda n: n if pandas.notna(n) and n not in c else pandas.NA
+class Profile:
+    """Times of the stages of creating tables, and amounts of data read.
+    Rows and bytes count only data read into pandas; tables aggregated by
+    SQLite show up in the traced SQL statements instead. Bytes and filtered
+    rows take another pass over the data, so they are counted only in
+    detailed profiles.
+    """
+
+    def __init__(self, detailed: bool = True):
+        self.detailed = detailed
+        self.time = 0.0
+        self.stages = {}
+        self.rows_read = 0
+        self.rows_filtered = 0
+        self.bytes = 0
+        self.cached = 0
+        self.sql = []
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time spent in the block to a stage"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def measure(self, conn):
+        """Measure the total time, and trace SQL statements run on the
+        connection
+        """
+
+        start = time.perf_counter()
+        conn.set_trace_callback(self.sql.append)
+        try:
+            yield
+        finally:
+            conn.set_trace_callback(None)
+            self.time += time.perf_counter() - start
+
+    def read(self, data):
+        """Count data read into pandas"""
+
+        self.rows_read += len(data.index)
+        if self.detailed:
+            self.bytes += int(data.memory_usage(deep=True).sum())
+
+    def as_dict(self):
+        """Get the profile in a form that can be sent as JSON"""
+
+        result = {
+            'time':     self.time,
+            'stages':   dict(self.stages),
+            'rowsRead': self.rows_read,
+            'cached':   self.cached,
+            'sql':      list(self.sql),
+        }
+        if self.detailed:
+            result['rowsFiltered'] = self.rows_filtered
+            result['bytes'] = self.bytes
+        return result
+
+
+def stage(profile, name):
+    """Measure a stage of creating tables, if they are profiled
+
+    Keyword arguments:
+    profile -- Profile or None
+    name -- name of the stage
+
+    Return value:
+    returns a context manager
+    """
+
+    return profile.stage(name) if profile is not None else nullcontext()
+
+
+def filter_gt(c):  return lambda s: s > c
+def filter_lt(c):  return lambda s: s < c
+def filter_le(c):  return lambda s: s <= c
+def filter_ge(c):  return lambda s: s >= c
+def filter_eq(c):  return lambda s: s == c
+def filter_ne(c):  return lambda s: s != c
+def filter_in(*c): return lambda s: s.isin(c)
+def filter_ni(*c): return lambda s: ~s.isin(c)
+
+
+def apply_filter(series: pandas.Series, predicate) -> pandas.Series:
+    """Replace values of a series that do not satisfy the predicate with NA.
+
+    Keyword arguments:
+    series -- the filtered series
+    predicate -- a mask function from FILTERS
+
+    Return value:
+    returns the series with filtered out values set to NA
+    """
+
+    # The predicate is evaluated on present values only, so NA never reaches
+    # the comparison and always ends up filtered out
+    present = series.notna().to_numpy(dtype=bool)
+    mask = numpy.zeros(len(series), dtype=bool)
+    if present.any():
+        mask[present] = predicate(series[present]).to_numpy(dtype=bool)
+    return series.where(mask, pandas.NA)
 
 
 def rows(s):  return len(s.index.unique())
@@ -49,16 +156,64 @@ def mode(s):
     return max(s, key=s.get)
 
 
+def tobasetypes_of(s):
+    """Convert values of a series one by one, the way tobasetypes does
+
+    Keyword arguments:
+    s -- pandas.Series
+
+    Return value:
+    returns a list of the values
+    """
+
+    s = s.apply(lambda x: int(x) if type(x) is float and x.is_integer() else x)
+    s = s.apply(lambda x: 0 if type(x) is float and x != x else x)
+    return s.tolist()
+
+
 def tobasetypes(s):
-    if isinstance(s.dtype, pandas.core.arrays.string_.StringDtype):
-        s = s.astype('string')
+    """Convert a series to a list of values of Python types, where integral
+    floats become ints and NaNs become 0. Applying the conversions to single
+    values makes pandas infer the types of the series again, so a float
+    column is left with ints only if all its values are integral.
+
+    Keyword arguments:
+    s -- pandas.Series
+
+    Return value:
+    returns a list of the values
+    """
+
     if isinstance(s.dtype, pandas.core.arrays.floating.Float64Dtype):
         s = s.astype('float')
     if isinstance(s.dtype, pandas.core.arrays.integer.Int64Dtype):
         s = s.astype('int')
-    s = s.apply(lambda x: int(x) if type(x) is float and x.is_integer() else x)
-    s = s.apply(lambda x: 0 if type(x) is float and x != x else x)
-    return s
+
+    values = s.to_numpy()
+    if values.dtype.kind in 'iub' or isinstance(s.dtype, pandas.StringDtype):
+        return s.tolist()
+
+    if values.dtype.kind == 'f':
+        nan = numpy.isnan(values)
+        integral = numpy.isfinite(values) & (values == numpy.floor(values))
+        # Integers out of the int64 range aren't turned back into floats
+        if not (integral & (numpy.abs(values) >= 2.0**63)).any():
+            if integral.all():
+                return values.astype(numpy.int64).tolist()
+            if nan.all():
+                return [0]*len(values)
+            return numpy.where(nan, 0.0, values).tolist()
+
+    elif values.dtype.kind == 'O':
+        # Series of dicts or strings, like the results of share, aren't
+        # converted to other types, so only floats have to be replaced
+        if any(type(x) in (dict, str) for x in values):
+            return [
+                (0 if x != x else int(x) if x.is_integer() else x) if type(x) is float else x
+                for x in values
+            ]
+
+    return tobasetypes_of(s)
 
 
 FILTERS = {
@@ -73,18 +228,33 @@ FILTERS = {
 }
 
 
+# The 'sql' expressions are used when the whole query can be computed by
+# SQLite. 'sqltypes' limit it to column types for which SQLite returns exactly
+# what pandas would: floating point sums are not reproducible bit for bit, and
+# pandas turns REAL columns holding only integers into Int64, which changes
+# the types of the results.
 AGGREGATORS = {
-    'share':  Aggregator(share,    'INTEGER', 'REAL', 'TEXT'),
+    'share':  Aggregator(share,    'INTEGER', 'REAL', 'TEXT', sql='COUNT(*)',                sqltypes=['INTEGER', 'TEXT']),
     'mode':   Aggregator(mode,     'INTEGER', 'REAL', 'TEXT'),
-    'rows':   Aggregator(rows,     'INTEGER', 'REAL', 'TEXT'),
-    'count':  Aggregator(count,    'INTEGER', 'REAL', 'TEXT'),
-    'max':    Aggregator('max',    'INTEGER', 'REAL'),
-    'min':    Aggregator('min',    'INTEGER', 'REAL'),
-    'mean':   Aggregator('mean',   'INTEGER', 'REAL'),
+    'rows':   Aggregator(rows,     'INTEGER', 'REAL', 'TEXT', sql='COUNT(*)'),
+    'count':  Aggregator(count,    'INTEGER', 'REAL', 'TEXT', sql='COUNT("{}")'),
+    'max':    Aggregator('max',    'INTEGER', 'REAL',         sql='MAX("{}")',               sqltypes=['INTEGER']),
+    'min':    Aggregator('min',    'INTEGER', 'REAL',         sql='MIN("{}")',               sqltypes=['INTEGER']),
+    'mean':   Aggregator('mean',   'INTEGER', 'REAL',         sql='AVG("{}")',               sqltypes=['INTEGER']),
     'median': Aggregator('median', 'INTEGER', 'REAL'),
     'std':    Aggregator('std',    'INTEGER', 'REAL'),
     'var':    Aggregator('var',    'INTEGER', 'REAL'),
-    'sum':    Aggregator('sum',    'INTEGER', 'REAL')
+    'sum':    Aggregator('sum',    'INTEGER', 'REAL',         sql='COALESCE(SUM("{}"), 0)', sqltypes=['INTEGER'])
+}
+
+# Types of columns that SQLite can group by, with keys equal to the pandas ones
+SQL_GROUP_TYPES = {'INTEGER', 'TEXT'}
+
+# pandas dtypes that convert_dtypes gives to columns of SQL types
+SQL_DTYPES = {
+    'INTEGER': 'Int64',
+    'REAL':    'Float64',
+    'TEXT':    'string',
 }
 
 
@@ -209,16 +379,55 @@ def get_sql_filter_of(json_filter, types):
 
     sql_filter = FILTERS[operator]
 
-    col_type = types[column]
+    # Values are bound as parameters, so the SQL depends only on the shape
+    # of the filter, and the values don't need quoting
+    placeholders = ['?']*len(args)
+
+    result = f'"{column}" {sql_filter.symbol} {sql_filter.beg}{sql_filter.sep.join(placeholders)}{sql_filter.end}'
+
+    return result, args
+
+
+def get_sql_where(query, types):
+    """Create an SQL condition out of the column name filters of a query
 
-    if col_type == "TEXT":
-        args = [f'"{arg}"' for arg in args]
+    Keyword arguments:
+    query -- survey data
+    types -- column types
+
+    Return value:
+    returns an SQL expression for the WHERE clause, with ? placeholders,
+    and a tuple of the values to bind to them; queries that differ only in
+    the filter values give the same expression
+    """
+
+    # Create an SQL inclusive filter string
+    sql_filters = None
+    if 'if' in query and query['if']:
+        sql_filters = [f for f in query['if'] if type(f[0]) is not int]
+    params = []
+    if sql_filters:
+        filters = list(map(lambda x: get_sql_filter_of(x, types), sql_filters))
+        params.extend(arg for _, args in filters for arg in args)
+        filters = [sql for sql, _ in filters]
     else:
-        args = [f'{arg}' for arg in args]
+        filters = ["TRUE"]
+    inclusive_filters = ' AND '.join(filters)
 
-    result = f'"{column}" {sql_filter.symbol} {sql_filter.beg}{sql_filter.sep.join(args)}{sql_filter.end}'
 
-    return result
+    # Create an SQL exclusive filter string
+    sql_filters = None
+    if 'except' in query and query['except']:
+        sql_filters = [f for f in query['except'] if type(f[0]) is not int]
+    if sql_filters:
+        filters = list(map(lambda x: get_sql_filter_of(x, types), sql_filters))
+        params.extend(arg for _, args in filters for arg in args)
+        filters = [sql for sql, _ in filters]
+    else:
+        filters = ["FALSE"]
+    exclusive_filters = ' AND '.join(filters)
+
+    return f'({inclusive_filters}) AND NOT ({exclusive_filters})', tuple(params)
 
 
 def get_pandas_filter_of(json_filter, ctype):
@@ -238,18 +447,16 @@ def get_pandas_filter_of(json_filter, ctype):
     return result
 
 
-def columns(query, types, conn: sqlite3.Connection):
-    """Obtain dataframe required to compute the query
+def required(query):
+    """Get names of database columns required to compute the query
 
     Keyword arguments:
     query -- survey data
-    conn -- sqlite3.Connection
 
     Return value:
-    returns dataframe object
+    returns a set of column names
     """
 
-    # Create an SQL column name list
     columns = set()
     for get in query['get']:
         columns.update(get)
@@ -260,37 +467,67 @@ def columns(query, types, conn: sqlite3.Connection):
         for join in query['join']:
             columns.discard(join['name'])
             columns.update(join['of'])
+    return columns
 
-    columns_to_select = ', '.join([f'"{elem}"' for elem in columns])
 
-    # types = database.get_types(conn)
+def select(columns, where, conn: sqlite3.Connection, version=None, profile=None):
+    """Read columns of the survey data
 
-    # Create an SQL inclusive filter string
-    sql_filters = None
-    if 'if' in query and query['if']:
-        sql_filters = [f for f in query['if'] if type(f[0]) is not int]
-    if sql_filters:
-        filters = list(map(lambda x: get_sql_filter_of(x, types), sql_filters))
-    else:
-        filters = ["TRUE"]
-    inclusive_filters = ' AND '.join(filters)
+    Keyword arguments:
+    columns -- names of the columns
+    where -- SQL condition for the rows and its parameters, as returned
+        from get_sql_where
+    conn -- sqlite3.Connection
+    version -- data version of the survey; if given, the columns are read
+        from its columnar store when possible (default: None)
+    profile -- Profile to record the read in (default: None)
 
+    Return value:
+    returns dataframe object
+    """
 
-    # Create an SQL exclusive filter string
-    sql_filters = None
-    if 'except' in query and query['except']:
-        sql_filters = [f for f in query['except'] if type(f[0]) is not int]
-    if sql_filters:
-        filters = list(map(lambda x: get_sql_filter_of(x, types), sql_filters))
-    else:
-        filters = ["FALSE"]
-    exclusive_filters = ' AND '.join(filters)
+    condition, params = where
+    data = store.load(version) if version is not None else None
+    if data is not None and data.has(columns):
+        with stage(profile, 'read'):
+            # Only ask the database which rows are selected, if any filter is set
+            rowids = None
+            if where != get_sql_where({}, {}):
+                rowids = [r for r, in conn.execute(f'SELECT rowid FROM data WHERE {condition} ORDER BY rowid;', params)]
+            src = data.frame(columns, rowids)
+        if profile is not None:
+            profile.read(src)
+        return src
 
+    columns_to_select = ', '.join([f'"{elem}"' for elem in columns])
 
     # Gather the data from the database
-    sql = f'SELECT {columns_to_select} FROM data WHERE ({inclusive_filters}) AND NOT ({exclusive_filters});'
-    src = pandas.read_sql_query(sql, conn)
-    src = src.convert_dtypes()
+    with stage(profile, 'read'):
+        sql = f'SELECT {columns_to_select} FROM data WHERE {condition};'
+        src = pandas.read_sql_query(sql, conn, params=params)
+    if profile is not None:
+        profile.read(src)
+    with stage(profile, 'convert_dtypes'):
+        return src.convert_dtypes()
+
+
+def columns(query, types, conn: sqlite3.Connection, src=None, profile=None):
+    """Obtain dataframe required to compute the query
+
+    Keyword arguments:
+    query -- survey data
+    conn -- sqlite3.Connection
+    src -- data read by select with the query's condition, if it was
+        already read along with other queries (default: None)
+    profile -- Profile to record the number of rows left after filtering
+        in (default: None)
+
+    Return value:
+    returns dataframe object
+    """
+
+    if src is None:
+        src = select(required(query), get_sql_where(query, types), conn, profile=profile)
 
     group_names = [c for c in query['by'] if not c.startswith('*')]
     groups = src[group_names]
@@ -300,16 +537,21 @@ def columns(query, types, conn: sqlite3.Connection):
     # Perform joins on columns
     if 'join' in query and query['join']:
         for join in query['join']:
-            # Append the column with data from source columns
-            for column in join['of']:
+            of = join['of']
+            if join['name'] not in dst:
+                # If no such column yet, it has to be created, not appended
+                part = src[[of[0]]]
+                part.columns = [join['name']]
+                dst = dst.join(part)
+                of = of[1:]
+            # Append the rest of the source columns at once
+            parts = []
+            for column in of:
                 part = src[[column]]
                 part.columns = [join['name']]
-                if join['name'] in dst:
-                    part = part.join(groups)
-                    dst = dst.append(part)
-                else:
-                    # If no such column yet, it has to be created, not appended
-                    dst = dst.join(part)
+                parts.append(part.join(groups))
+            if parts:
+                dst = pandas.concat([dst] + parts)
 
     # Apply column-specific filters
     # Obtain column filter list
@@ -334,13 +576,17 @@ def columns(query, types, conn: sqlite3.Connection):
 
             if i in filters:
                 for f in filters[i]:
-                    series = series.apply(get_pandas_filter_of(f, types[column]))
+                    series = apply_filter(series, get_pandas_filter_of(f, types[column]))
 
             series = series.astype(dtype)
             dst = dst.assign(**{name: series})
 
     dst.fillna(pandas.NA, inplace=True)
 
+    if profile is not None and profile.detailed:
+        outputs = [f'{query["as"][i]} {c}' for get in query['get'] for i, c in enumerate(get)]
+        profile.rows_filtered += int(dst[outputs].notna().any(axis='columns').sum())
+
     return dst
 
 
@@ -369,26 +615,30 @@ def aggregate(query, data):
     if 'by' not in query or not query['by']:
         query['by'] = ['*']
 
-    groups = [(g if g.startswith('*') else f'group {g}') for g in query['by']]
-
-    result = None
-    for group in groups:
-        name = None
-
-        if group.startswith('*'):
-            if len(group) > 1:
-                name = group[1:]
-            group = lambda x: True
-
-        ingroups = data.copy().groupby(group).aggregate(columns)
+    # Compute every distinct grouping set once, then lay them out in the
+    # requested order. Totals are grouped by a constant key array, which
+    # doesn't call back into Python for every row.
+    groupings = {}
+    for by in query['by']:
+        key = '*' if by.startswith('*') else f'group {by}'
+        if key in groupings:
+            continue
+        if key == '*':
+            key_values = numpy.ones(len(data.index), dtype=bool)
+        else:
+            key_values = key
+        groupings[key] = aggregate_groups(data.groupby(key_values), data, columns)
 
-        if name is not None:
-            ingroups.index = [name]*len(ingroups.index)
-        if result is None:
-            result = ingroups
+    parts = []
+    for by in query['by']:
+        if by.startswith('*'):
+            ingroups = groupings['*']
+            if len(by) > 1:
+                ingroups = ingroups.set_axis([by[1:]]*len(ingroups.index), axis='index')
         else:
-            result = pandas.concat([result, ingroups])
-    return result
+            ingroups = groupings[f'group {by}']
+        parts.append(ingroups)
+    return pandas.concat(parts)
 
 
 def reorder(data):
@@ -401,36 +651,418 @@ def reorder(data):
     returns survey reordered data
     """
 
-    data = data.apply(tobasetypes)
+    result = {}
+    result['index'] = [x if x is not True else '*' for x in data.index.tolist()]
+    for (label, aggr), column in data.items():
+        result[f'{label}'] = tobasetypes(column)
+    return result
 
-    data.columns = [f'{label}' for label, aggr in data.columns]
 
-    result = {}
-    result['index'] = list(map(lambda x: x if x is not True else '*', data.index.tolist()))
-    for column in data:
-        result[column] = data[column].tolist()
+def pushable(query, types):
+    """Check if a query can be computed entirely by SQLite
+
+    Keyword arguments:
+    query -- survey data
+    types -- column types
+
+    Return value:
+    returns True if aggregate_sql gives the same result as the pandas path
+    """
+
+    # Joins and filters on the output columns are pandas-only
+    if 'join' in query and query['join']:
+        return False
+    for cond in ['if', 'except']:
+        if cond in query and query[cond]:
+            if any(type(f[0]) is int for f in query[cond]):
+                return False
+
+    for by in query['by']:
+        if not by.startswith('*') and types[by] not in SQL_GROUP_TYPES:
+            return False
+
+    names = set()
+    for get in query['get']:
+        for i, column in enumerate(get):
+            aggr = AGGREGATORS[query['as'][i]]
+            name = f'{query["as"][i]} {column}'
+            if aggr.sql is None or types[column] not in aggr.sqltypes:
+                return False
+            # pandas refuses to compute the same aggregation twice
+            if name in names:
+                return False
+            names.add(name)
+    return True
+
+
+def share_of_counts(values, counts, dtype):
+    """Compute share out of value counts, exactly as share would do it
+
+    Keyword arguments:
+    values -- distinct values in the order of their first appearance
+    counts -- number of occurences of each of the values
+    dtype -- pandas dtype of the column
+
+    Return value:
+    returns a dict from values to their counts
+    """
+
+    if len(set(counts)) == len(counts):
+        order = numpy.argsort(counts, kind='stable')[::-1]
+    else:
+        order = order_of_ties(values, counts, dtype)
+    return {values[i]: int(counts[i]) for i in order}
+
+
+# Orders in which pandas lists tied counts, by dtype and ranks of the counts
+TIES = cache.LRU(4096)
+
+
+def order_of_ties(values, counts, dtype):
+    """Get the order in which value_counts lists values with tied counts
+
+    Keyword arguments:
+    values -- distinct values in the order of their first appearance
+    counts -- number of occurences of each of the values
+    dtype -- pandas dtype of the column
+
+    Return value:
+    returns indices of the values, in the order of value_counts
+    """
+
+    # The order of ties depends on pandas internals. pandas sorts the counts
+    # by comparing them, so the order depends only on the ranks of the counts
+    # and it can be found by counting a short series with the same ranks.
+    ranks = numpy.unique(counts, return_inverse=True)[1] + 1
+    key = (str(dtype), tuple(ranks.tolist()))
+    order = TIES.get(key)
+    if order is None:
+        sample = pandas.Series(numpy.repeat(numpy.array(values, dtype=object), ranks), dtype=dtype)
+        position = {v: i for i, v in enumerate(values)}
+        order = [position[v] for v in sample.value_counts().index]
+        TIES.put(key, order)
+    return order
+
+
+def count_groups(series, groups, ngroups):
+    """Count values of a series in all groups at once. Values are encoded
+    as categorical codes, and pairs of group and value codes are counted
+    with a single sort.
+
+    Keyword arguments:
+    series -- the values
+    groups -- group number of every row, or -1 if the row is in no group
+    ngroups -- number of groups
+
+    Return value:
+    returns a list with distinct values of every group, in the order of
+    their first appearance, and a list with their counts
+    """
+
+    codes, uniques = pandas.factorize(series)
+    valid = (codes >= 0) & (groups >= 0)
+    pairs = groups[valid].astype(numpy.int64)*len(uniques) + codes[valid]
+    pairs, first, counts = numpy.unique(pairs, return_index=True, return_counts=True)
+
+    # Sort the values of every group by their first appearance
+    group, code = numpy.divmod(pairs, max(len(uniques), 1))
+    order = numpy.lexsort((first, group))
+    group, code, counts = group[order], code[order], counts[order]
+    bounds = numpy.searchsorted(group, numpy.arange(ngroups + 1))
+
+    uniques = list(uniques)
+    values = []
+    for g in range(ngroups):
+        values.append([uniques[c] for c in code[bounds[g]:bounds[g+1]]])
+    return values, numpy.split(counts, bounds[1:-1])
+
+
+def share_groups(series, groups, ngroups):
+    """Compute share in all groups at once, exactly as share would do it"""
+
+    values, counts = count_groups(series, groups, ngroups)
+    return [share_of_counts(v, c, series.dtype) for v, c in zip(values, counts)]
+
+
+def mode_groups(series, groups, ngroups):
+    """Compute mode in all groups at once, exactly as mode would do it"""
+
+    values, counts = count_groups(series, groups, ngroups)
+    result = []
+    for v, c in zip(values, counts):
+        if len(c) == 0:
+            result.append(mode(series.iloc[:0]))
+        elif (c == c.max()).sum() > 1:
+            # The first of the tied values in the order of value_counts
+            result.append(v[order_of_ties(v, c, series.dtype)[0]])
+        else:
+            result.append(v[c.argmax()])
     return result
 
 
-def create(query, conn: sqlite3.Connection):
+# Aggregators computed for all groups at once, and dtypes they support
+GROUPED = {share: share_groups, mode: mode_groups}
+GROUPED_DTYPES = {'Int64', 'Float64', 'string', 'boolean', 'int64', 'float64', 'bool'}
+
+
+def aggregate_groups(grouped, data, columns):
+    """Aggregate grouped survey data, computing share and mode for all groups
+    at once
+
+    Keyword arguments:
+    grouped -- data grouped by pandas
+    data -- dataframe object
+    columns -- dict from column names to lists of aggregator functions
+
+    Return value:
+    returns aggregated data, the same as grouped.aggregate(columns)
+    """
+
+    kernels = {}
+    for name, funcs in columns.items():
+        if len(funcs) == 1 and funcs[0] in GROUPED and str(data[name].dtype) in GROUPED_DTYPES:
+            kernels[name] = funcs[0]
+    if not kernels:
+        return grouped.aggregate(columns)
+
+    rest = {name: funcs for name, funcs in columns.items() if name not in kernels}
+    if rest:
+        result = grouped.aggregate(rest)
+        index = result.index
+    else:
+        index = grouped.size().index
+    groups = grouped.ngroup().fillna(-1).to_numpy(dtype=numpy.int64)
+
+    aggregated = {}
+    for name, funcs in columns.items():
+        if name in kernels:
+            func = kernels[name]
+            values = GROUPED[func](data[name], groups, len(index))
+            # pandas casts the results back to the dtype of the column if it can
+            dtype = data[name].dtype if func is mode else object
+            aggregated[(name, func.__name__)] = pandas.Series(values, index=index, dtype=dtype)
+        else:
+            for func in funcs:
+                label = func if type(func) is str else func.__name__
+                aggregated[(name, label)] = result[(name, label)]
+    return pandas.DataFrame(aggregated, index=index)
+
+
+def group_sql(query, types, by, conn: sqlite3.Connection):
+    """Aggregate survey data in SQLite for a single grouping
+
+    Keyword arguments:
+    query -- survey data
+    types -- column types
+    by -- the grouping column name, or '*' for all rows
+    conn -- sqlite3.Connection
+
+    Return value:
+    returns a list of group keys and a dict of aggregated values for each
+    output column, or None if the result can't match the pandas path
+    """
+
+    where, params = get_sql_where(query, types)
+    if by == '*':
+        key, group = '', 'HAVING COUNT(*) > 0'
+    else:
+        key = f'"{by}", '
+        where = f'{where} AND "{by}" IS NOT NULL'
+        group = f'GROUP BY "{by}" ORDER BY "{by}"'
+
+    outputs = []
+    for get in query['get']:
+        for i, column in enumerate(get):
+            outputs.append((query['as'][i], column))
+
+    # Compute all scalar aggregations, and the list of groups, in one query
+    scalars = [(a, c) for a, c in outputs if a != 'share']
+    aggrs = ', '.join(['COUNT(*)'] + [AGGREGATORS[a].sql.format(c) for a, c in scalars])
+    cur = conn.cursor()
+    cur.execute(f'SELECT {key}{aggrs} FROM data WHERE {where} {group};', params)
+
+    keys = []
+    values = {f'{a} {c}': [] for a, c in outputs}
+    for row in cur.fetchall():
+        if by == '*':
+            keys.append(True)
+        else:
+            keys.append(row[0])
+            row = row[1:]
+        for (a, c), value in zip(scalars, row[1:]):
+            # A mean of no values is NaN, and pandas fails on other NAs
+            if value is None and a == 'mean':
+                value = float('nan')
+            elif value is None:
+                return None
+            values[f'{a} {c}'].append(value)
+
+    # Value counts are listed in the order of first appearance of each value,
+    # so that sorting them gives ties in the same order as value_counts
+    for a, c in outputs:
+        if a != 'share':
+            continue
+        cur.execute(f'SELECT {key}"{c}", {AGGREGATORS[a].sql} FROM data '
+                    f'WHERE {where} AND "{c}" IS NOT NULL '
+                    f'GROUP BY {key}"{c}" ORDER BY {key}MIN(rowid);', params)
+        counts = {k: ([], []) for k in keys}
+        for row in cur.fetchall():
+            k = True if by == '*' else row[0]
+            counts[k][0].append(row[-2])
+            counts[k][1].append(row[-1])
+        dtype = SQL_DTYPES[types[c]]
+        for k in keys:
+            values[f'{a} {c}'].append(share_of_counts(*counts[k], dtype))
+
+    return keys, values
+
+
+def aggregate_sql(query, types, conn: sqlite3.Connection):
+    """Aggregate survey data in SQLite, without reading it into pandas
+
+    Keyword arguments:
+    query -- survey data
+    types -- column types
+    conn -- sqlite3.Connection
+
+    Return value:
+    returns data in the format of reorder, or None if the query has to be
+    computed by pandas
+    """
+
+    groupings = {}
+    result = {'index': []}
+    for by in query['by']:
+        key = '*' if by.startswith('*') else by
+        if key not in groupings:
+            groupings[key] = group_sql(query, types, key, conn)
+            if groupings[key] is None:
+                return None
+        keys, values = groupings[key]
+
+        if by.startswith('*'):
+            keys = [by[1:] if len(by) > 1 else '*']*len(keys)
+        result['index'].extend(keys)
+        for name, vals in values.items():
+            result.setdefault(name, []).extend(vals)
+
+    # Convert the values the same way reorder does
+    for name, vals in result.items():
+        if name != 'index' and vals:
+            result[name] = tobasetypes(pandas.Series(vals))
+    return result
+
+
+def normalize(query):
+    """Create a canonical form of a checked query
+
+    Keyword arguments:
+    query -- survey data, after applymacros and typecheck
+
+    Return value:
+    returns a string equal for all queries that give the same table
+    """
+
+    canonical = {k: v for k, v in query.items() if k != 'macro'}
+
+    # Filters are conjunctive, so their order doesn't matter
+    for cond in ['if', 'except']:
+        if cond in canonical:
+            canonical[cond] = sorted(canonical[cond], key=lambda f: json.dumps(f))
+    return json.dumps(canonical, sort_keys=True)
+
+
+CACHE = cache.LRU(TABLE_CACHE_ENTRIES, TABLE_CACHE_SIZE, sizeof=lambda table: len(repr(table)))
+
+
+def create_many(queries, conn: sqlite3.Connection, version=None, profile=None):
+    """Create many tables out of the same survey data at once. Column types
+    are obtained once, and queries that select the same rows share a single
+    read of all the columns that they need.
+
+    Keyword arguments:
+    queries -- list of survey data queries
+    conn -- sqlite3.Connection
+    version -- data version of the survey, as returned from
+        database.get_data_version; if given, the tables are cached
+    profile -- Profile to record times of the stages, the amounts of data
+        read and the SQL statements in (default: None)
+
+    Return value:
+    returns a list with survey data or an error.API for every query; the
+    survey data must not be modified if version is given
+    """
+
+    with profile.measure(conn) if profile is not None else nullcontext():
+        with stage(profile, 'schema'):
+            alltypes = database.get_schema(conn, version).types
+        tables = [None]*len(queries)
+        keys = [None]*len(queries)
+        reads = {}
+        for i, query in enumerate(queries):
+            try:
+                types = dict(alltypes)
+                with stage(profile, 'applymacros'):
+                    query = applymacros(query)
+                with stage(profile, 'typecheck'):
+                    typecheck(query, types)
+
+                if version is not None:
+                    with stage(profile, 'cache'):
+                        keys[i] = (version, normalize(query))
+                        tables[i] = CACHE.get(keys[i])
+                    if tables[i] is not None:
+                        if profile is not None:
+                            profile.cached += 1
+                        continue
+
+                # Let SQLite aggregate the data whenever it's possible
+                with stage(profile, 'sql'):
+                    if pushable(query, types):
+                        tables[i] = aggregate_sql(query, types, conn)
+                if tables[i] is None:
+                    where = get_sql_where(query, types)
+                    reads.setdefault(where, []).append((i, query, types))
+            except error.API as err:
+                tables[i] = err.add_details('could not create table')
+
+        # Compute the rest in pandas, reading data once for each distinct condition
+        for where, pending in reads.items():
+            src = select(set().union(*[required(q) for _, q, _ in pending]), where, conn, version, profile)
+            for i, query, types in pending:
+                try:
+                    with stage(profile, 'filters'):
+                        data = columns(query, types, conn, src, profile)
+                    with stage(profile, 'groupby'):
+                        data = aggregate(query, data)
+                    with stage(profile, 'reorder'):
+                        tables[i] = reorder(data)
+                except error.API as err:
+                    tables[i] = err.add_details('could not create table')
+
+        if version is not None:
+            for key, table in zip(keys, tables):
+                if key is not None and not isinstance(table, error.API):
+                    CACHE.put(key, table)
+    return tables
+
+
+def create(query, conn: sqlite3.Connection, version=None, profile=None):
     """Create data from survey
 
     Keyword arguments:
     query -- survey data
     conn -- sqlite3.Connection
+    version -- data version of the survey, as returned from
+        database.get_data_version; if given, the table is cached
+    profile -- Profile to record the stages of creating the table in
+        (default: None)
 
     Return value:
-    returns survey data
+    returns survey data, which must not be modified if version is given
     """
 
-    try:
-        types = database.get_types(conn)
-        query = applymacros(query)
-        typecheck(query, types)
-        data = columns(query, types, conn)
-        data = aggregate(query, data)
-        table = reorder(data)
-    except error.API as err:
-        err.add_details('could not create table')
-        raise
+    table, = create_many([query], conn, version, profile)
+    if isinstance(table, error.API):
+        raise table
     return table
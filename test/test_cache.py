@@ -0,0 +1,39 @@
+import unittest
+import cache
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.LRU(2, 10, sizeof=len)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 'xyz')
+        self.assertEqual(self.cache.get('a'), 'xyz')
+        self.assertEqual(self.cache.stats(), {'entries': 1, 'size': 3, 'hits': 1, 'misses': 1})
+
+    def test_evict_least_recently_used(self):
+        self.cache.put('a', 'x')
+        self.cache.put('b', 'y')
+        self.cache.get('a')
+        self.cache.put('c', 'z')
+        self.assertEqual(self.cache.get('a'), 'x')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 'z')
+
+    def test_evict_by_size(self):
+        self.cache.put('a', 'xxxxxx')
+        self.cache.put('b', 'yyyyyy')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['size'], 6)
+        self.cache.put('c', 'z'*11)
+        self.assertIsNone(self.cache.get('c'))
+
+    def test_invalidate(self):
+        self.cache.put(('a', 1), 'x')
+        self.cache.put(('b', 1), 'y')
+        self.cache.invalidate(lambda key: key[0] == 'a')
+        self.assertIsNone(self.cache.get(('a', 1)))
+        self.assertEqual(self.cache.get(('b', 1)), 'y')
+        self.assertEqual(self.cache.stats()['size'], 1)
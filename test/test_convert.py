@@ -0,0 +1,82 @@
+import unittest
+import tempfile
+import sqlite3
+import pandas
+import numpy
+import openpyxl
+import convert
+import os
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pandas.DataFrame({
+            'A.1': [9999, 1, 9999, 2, numpy.nan],
+            'A.2': [3, 9999, 9999, 2, numpy.nan],
+            'A': [9999, 9999, 9999, 4, 5],
+            'B.1': [1, 1, 2, 3, 3],
+            'B': [1, 2, 2, 4, 3],
+            'C.1': ['x', numpy.nan, 'y', 'y', numpy.nan],
+            'C': [1, numpy.nan, numpy.nan, 'y', 2],
+        })
+
+    def assertSameMerge(self, group, defaults, name):
+        expected = self.df[group].aggregate(convert.nodefaults(defaults, name), axis='columns')
+        result = convert.merge_columns(self.df, group, defaults, name)
+        pandas.testing.assert_series_equal(result, expected)
+
+    def test_merge_columns(self):
+        defaults = {'A': {'9999'}, 'B': {'9999', '1'}, 'C': {'9999', 'x'}}
+        for d in (defaults, {}):
+            self.assertSameMerge(['A.1', 'A.2', 'A'], d, 'A')
+            self.assertSameMerge(['B.1', 'B'], d, 'B')
+            self.assertSameMerge(['C.1', 'C'], d, 'C')
+
+    def test_raw_to_compact(self):
+        result = convert.raw_to_compact(None, self.df.copy(), {'A': {'9999'}})
+        self.assertEqual(list(result.columns), ['A', 'B', 'C'])
+        self.assertEqual(list(result['B']), [1, 1, 2, 3, 3])
+
+    def test_read_csv_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.csv')
+            with open(path, 'w') as file:
+                file.write('a,b,c\n1,1,True\n2,2,False\n3,,True\n,x,\n')
+            chunks = list(convert.read_csv_chunks(path, ',', 2))
+        self.assertEqual([len(c) for c in chunks], [2, 2])
+        self.assertEqual([str(c['a'].dtype) for c in chunks], ['float64', 'float64'])
+        self.assertEqual(chunks[0]['b'].tolist(), ['1', '2'])
+        self.assertEqual(chunks[0]['c'].tolist(), [True, False])
+        self.assertEqual(chunks[0]['c'].dtype, object)
+
+    def test_write_data(self):
+        frames = [
+            pandas.DataFrame({'a': [1, 2], 'b': [1, 2], 'c': pandas.Series([1, numpy.nan], dtype=object)}),
+            pandas.DataFrame({'a': [3, 4], 'b': [numpy.nan, 4.5], 'c': pandas.Series(['x', 3], dtype=object)}, index=[2, 3]),
+        ]
+        expected = sqlite3.connect(':memory:')
+        pandas.concat(frames).infer_objects().to_sql('data', expected)
+        conn = sqlite3.connect(':memory:')
+        convert.write_data(conn, iter(frames))
+        for query in ('PRAGMA table_info(data)', 'SELECT * FROM data', 'SELECT typeof(b), typeof(c) FROM data'):
+            self.assertEqual(conn.execute(query).fetchall(), expected.execute(query).fetchall())
+        conn.close()
+        expected.close()
+
+    def test_read_xlsx_chunks(self):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(['A', 'A', 'B', None, 'C', 'D', 'E'])
+        sheet.append([1, 1.5, 'x', None, 'True', '#DIV/0!', True])
+        sheet.append([None, 2.0, 5, None, 'False', 3, False])
+        sheet.append([])
+        sheet.append([3, 2.5, 'NA', None, None, '4', True, 'y'])
+        sheet.append([])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.xlsx')
+            workbook.save(path)
+            expected = pandas.read_excel(path)
+            for rows in (0, 1, 2):
+                result = pandas.concat(convert.read_xlsx_chunks(path, rows), ignore_index=True)
+                pandas.testing.assert_frame_equal(result, expected, check_column_type=False)
@@ -1,7 +1,10 @@
 from database import *
 from globals import app
 from datetime import datetime
+from sqlalchemy import event
 import unittest
+import tempfile
+import shutil
 
 
 class TestCase(unittest.TestCase):
@@ -58,6 +61,7 @@ class TestCase(unittest.TestCase):
         db.session.commit()
 
     def tearDown(self):
+        db.session.remove()
         db.drop_all()
 
     def test_get_survey(self):
@@ -127,6 +131,21 @@ class TestCase(unittest.TestCase):
         expected = ['student', 'wmi']
         self.assertListEqual(result, expected)
 
+    def test_get_group_users(self):
+        self.assertEqual([u.id for u in get_group_users('student')], [1, 2])
+        self.assertEqual(get_group_users('nobody'), [])
+
+    def test_get_all_groups(self):
+        for i in range(20):
+            db.session.add(UserGroup(UserId=2, Group=f'grupa{i}'))
+        db.session.add(UserGroup(UserId=99, Group='pusta'))
+        db.session.commit()
+        expected = {group: [u.as_dict() for u in get_group_users(group)] for group in get_groups()}
+        self.assertEqual(self.count_queries(get_all_groups), 1)
+        self.assertEqual(get_all_groups(), expected)
+        self.assertEqual(list(get_all_groups()), sorted(expected))
+        self.assertEqual(get_all_groups()['pusta'], [])
+
     def test_set_user_groups(self):
         set_user_group(self.user2, 'dyrektor')
         self.assertListEqual(['dyrektor', 'student'], get_user_groups(self.user2))
@@ -134,3 +153,157 @@ class TestCase(unittest.TestCase):
     def test_unset_user_group(self):
         unset_user_group(self.user2, 'dyrektor')
         self.assertListEqual(['student'], get_user_groups(self.user2))
+
+    def count_queries(self, f) -> int:
+        queries = []
+        count = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return len(queries)
+
+    def count_dashboard_queries(self, login: str) -> int:
+        with app.test_request_context():
+            session['username'] = login
+            return self.count_queries(get_dashboard)
+
+    def test_get_dashboard_queries(self):
+        counts = {'admin': [], 'user': []}
+        for n in [5, 40]:
+            while Survey.query.count() < n:
+                survey = Survey(Name='Ankieta', AuthorId=1, AnswersCount=10)
+                db.session.add(survey)
+                db.session.commit()
+                db.session.add(Report(Name='Raport', SurveyId=survey.id, AuthorId=2))
+                db.session.add(SurveyPermission(SurveyId=survey.id, UserId=2, Type='r'))
+                db.session.add(ReportPermission(ReportId=survey.id, UserId=2, Type='w'))
+                db.session.commit()
+            for login in counts:
+                counts[login].append(self.count_dashboard_queries(login))
+        for login, c in counts.items():
+            self.assertEqual(len(set(c)), 1, f'queries of {login} grow with the number of surveys: {c}')
+            self.assertLessEqual(c[0], 12)
+
+    def test_migrate(self):
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.makedirs(f'{tmp}/data')
+        os.chdir(tmp)
+        try:
+            conn = sqlite3.connect('data/1.db')
+            conn.execute('CREATE TABLE data (a)')
+            conn.executemany('INSERT INTO data VALUES (?)', [(1,), (2,), (3,)])
+            conn.commit()
+            conn.close()
+            db.session.execute(db.text('ALTER TABLE Surveys DROP COLUMN AnswersCount'))
+            db.session.execute(db.text('DROP INDEX ix_Users_Login'))
+            db.session.execute(db.text('ALTER TABLE Users DROP COLUMN Login'))
+            db.session.commit()
+            db.session.expire_all()
+            migrate()
+            self.assertEqual(create_indexes(), ['ix_Users_Login'])
+            self.assertEqual(get_survey(1).AnswersCount, 3)
+            self.assertEqual(get_user('user').CasLogin, 'user')
+            plan = db.session.execute(db.text("EXPLAIN QUERY PLAN SELECT * FROM Users WHERE Login = 'user'")).fetchall()
+            self.assertIn('ix_Users_Login', str(plan))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+    def test_indexes(self):
+        queries = {
+            'SurveyPermissions': 'SELECT * FROM SurveyPermissions WHERE UserId = 1',
+            'ReportPermissions': 'SELECT * FROM ReportPermissions WHERE UserId = 1',
+            'UserGroups': "SELECT UserId FROM UserGroups WHERE \"Group\" = 'student'",
+        }
+        for table, query in queries.items():
+            plan = str(db.session.execute(db.text(f'EXPLAIN QUERY PLAN {query}')).fetchall())
+            self.assertIn(f'USING INDEX ix_{table}_', plan)
+
+    def test_create_indexes(self):
+        self.assertEqual(create_indexes(), [])
+        db.session.execute(db.text('DROP INDEX ix_SurveyPermissions_UserId'))
+        db.session.commit()
+        self.assertEqual(create_indexes(), ['ix_SurveyPermissions_UserId'])
+        self.assertEqual(create_indexes(), [])
+
+    def test_configure_connection(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            engine = db.create_engine(f'sqlite:///{tmp}/master.db', {})
+            with engine.connect() as conn:
+                self.assertEqual(conn.execute(db.text('PRAGMA journal_mode')).scalar(), 'wal')
+                self.assertEqual(conn.execute(db.text('PRAGMA synchronous')).scalar(), 1)
+                self.assertEqual(conn.execute(db.text('PRAGMA busy_timeout')).scalar(), DATABASE_TIMEOUT * 1000)
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_get_users(self):
+        db.session.add(User(CasLogin='student@example.com', Pesel='12345678901', Role='u', FetchData=False))
+        db.session.commit()
+        users = get_users([2, 'student@example.com', 'student', '12345678901', 'admin'])
+        self.assertEqual([u.id for u in users], [2, 3, 3, 3, 1])
+        self.assertEqual(get_user('student').id, 3)
+        for login in [4, 'nobody', 'nobody@example.com', '']:
+            with self.assertRaises(error.API):
+                get_users([1, login])
+
+    def test_set_permissions(self):
+        for i in range(50):
+            db.session.add(User(CasLogin=f'student{i}', Role='u', FetchData=False))
+        db.session.add(SurveyPermission(SurveyId=1, UserId=2, Type='w'))
+        db.session.commit()
+        students = User.query.filter(User.id > 2).all()
+        user2 = get_user(2)
+        permissions = [(u, 'r') for u in students] + [(user2, 'n'), (students[0], 'w')]
+        self.assertEqual(self.survey.id, 1)
+        count = self.count_queries(lambda: set_survey_permissions(self.survey, permissions))
+        self.assertLessEqual(count, 2)
+        self.assertEqual(SurveyPermission.query.count(), 50)
+
+        set_report_permissions(self.report, [(u, 'r') for u in students])
+        set_report_permissions(self.report, [(u, 'o') for u in students[:10]])
+        with app.test_request_context():
+            self.assertEqual(get_survey_permission(self.survey, students[0]), 'w')
+            self.assertEqual(get_survey_permission(self.survey, students[1]), 'r')
+            self.assertEqual(get_survey_permission(self.survey, user2), 'n')
+            self.assertEqual(get_report_permission(self.report, students[9]), 'o')
+            self.assertEqual(get_report_permission(self.report, students[10]), 'r')
+
+    def test_set_users_groups(self):
+        user2 = get_user(2)
+        set_users_groups({'student': [self.user, user2], 'dyrektor': [user2]})
+        self.assertListEqual(['dyrektor', 'student'], get_user_groups(user2))
+        self.assertEqual(UserGroup.query.filter_by(Group='student').count(), 2)
+        unset_users_groups({'student': [self.user, user2], 'wmi': [user2]})
+        self.assertListEqual(['wmi'], get_user_groups(self.user))
+        self.assertListEqual(['dyrektor'], get_user_groups(user2))
+
+    def test_request_context(self):
+        db.session.add(SurveyPermission(SurveyId=1, UserId=2, Type='w'))
+        db.session.commit()
+        with app.test_request_context():
+            session['username'] = 'user'
+            user = get_user()
+            self.assertEqual(user.CasLogin, 'user')
+            self.assertEqual((self.survey.id, self.report.id), (1, 1))
+            count = self.count_queries(lambda: [get_user(), get_survey_permission(self.survey, user), get_report_permission(self.report, user)])
+            self.assertEqual(count, 2)
+            self.assertEqual(self.count_queries(lambda: get_survey_permissions([self.survey], get_user())), 0)
+            self.assertEqual(get_report_permission(self.report, user), 'n')
+
+            set_report_permission(self.report, user, 'r')
+            self.assertEqual(get_report_permission(self.report, user), 'r')
+            set_survey_permission(self.survey, user, 'n')
+            self.assertEqual(get_survey_permission(self.survey, user), 'n')
+
+            # Permissions of other users are not cached
+            admin = get_user('admin')
+            self.assertEqual(get_survey_permission(self.survey, admin), ADMIN_DEFAULT_PERMISSION)
+            self.assertEqual(self.count_queries(lambda: get_survey_permission(self.survey, admin)), 1)
+
+            session['username'] = 'admin'
+            self.assertEqual(get_user().id, admin.id)
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+import unittest
+import tempfile
+import shutil
+import definitions
+import database
+import convert
+import json
+import os
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<questionnaire>
+<page id="p1">
+<header>Strona</header>
+ <questions>
+ <single required="true" defaultValue="8888" id="q1">
+  <header><![CDATA[Pytanie]]></header>
+   <answers>
+    <textitem code="1" value="Tak" rotate="false"/>
+   </answers>
+ </single>
+ </questions>
+</page>
+</questionnaire>
+'''
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(f'{self.dir}/survey')
+        os.chdir(self.dir)
+        with open('survey/1.xml', 'w') as file:
+            file.write(XML)
+        self.survey = SimpleNamespace(id=1, Name='Ankieta')
+
+    def tearDown(self):
+        definitions.invalidate(1)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        definition = definitions.load(1)
+        self.assertIs(definitions.load(1), definition)
+        self.assertEqual(convert.get_default_values(self.survey), {'Pytanie': {'9999', '8888'}})
+        self.assertEqual(database.get_answers(1)['Pytanie']['values'], {'8888': 'default', '1': 'Tak'})
+        self.assertEqual(set(definition.values), {'defaults', 'answers'})
+
+        with open('survey/1.xml', 'w') as file:
+            file.write(XML.replace('Pytanie', 'Pytanie 2'))
+        self.assertIsNot(definitions.load(1), definition)
+        self.assertIn('Pytanie 2', database.get_answers(1))
+
+    def test_json_to_xml(self):
+        survey = convert.xml_to_json(self.survey)
+        definition = definitions.load(1)
+        convert.json_to_xml(self.survey, json.loads(survey))
+        self.assertEqual(convert.xml_to_json(self.survey), survey)
+        self.assertIsNot(definitions.load(1), definition)
+
+
+if __name__ == '__main__':
+    unittest.main()
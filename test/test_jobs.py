@@ -0,0 +1,128 @@
+from database import *
+from globals import app
+from sqlalchemy.orm import Query
+from unittest import mock
+import unittest
+import tempfile
+import shutil
+import jobs
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        db.create_all()
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(f'{self.dir}/raw')
+        os.makedirs(f'{self.dir}/data')
+        os.chdir(self.dir)
+        self.user = User(CasLogin='admin', Pesel='9999999999', Role='s', FetchData=False)
+        self.survey = Survey(id=1, Name='Ankieta testowa', QuestionCount=0)
+        self.survey2 = Survey(id=2, Name='Ankieta testowa 2', QuestionCount=0)
+        db.session.add_all([self.user, self.survey, self.survey2])
+        db.session.commit()
+        with open('raw/1.csv', 'w') as file:
+            file.write('A,B,B\n1,x,9999\n2,9999,y\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+        db.session.remove()
+        db.drop_all()
+
+    def queue(self, survey, filename):
+        # Queues a job after the pending ones, which submit doesn't do
+        now = datetime.now()
+        job = Job(SurveyId=survey.id, UserId=self.user.id, Filename=filename, CreatedOn=now, UpdatedOn=now)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    def test_run(self):
+        job = jobs.submit(self.survey, self.user, '1.csv', {'B': {'9999'}})
+        self.assertEqual(job.as_dict()['state'], 'queued')
+        self.assertEqual(claim_job(), job)
+        self.assertIsNone(claim_job())
+        jobs.run(job)
+
+        result = get_job(job.id).as_dict()
+        self.assertEqual(result['state'], 'done')
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['progress'], {'parse': 100, 'compact': 100, 'write': 100})
+        self.assertEqual(self.survey.QuestionCount, 3)
+        self.assertEqual(self.survey.AnswersCount, 2)
+        conn = open_survey(self.survey)
+        self.assertEqual(conn.execute('SELECT "A", "B" FROM data').fetchall(), [(1, 'x'), (2, 'y')])
+        conn.close()
+        self.assertFalse(os.path.exists('raw/1.csv'))
+
+    def test_submit_pending(self):
+        job = jobs.submit(self.survey, self.user, '1.csv', {})
+        with self.assertRaises(error.API):
+            jobs.submit(self.survey, self.user, '1.csv', {})
+        self.assertEqual(jobs.submit(self.survey2, self.user, '2.csv', {}).SurveyId, 2)
+        finish_job(job)
+        self.assertEqual(jobs.submit(self.survey, self.user, '1.csv', {}).State, 'queued')
+        self.assertEqual(Job.query.filter_by(SurveyId=1).count(), 2)
+
+    def test_failed(self):
+        job = jobs.submit(self.survey2, self.user, '2.csv', {})
+        jobs.run(claim_job())
+        result = get_job(job.id).as_dict()
+        self.assertEqual(result['state'], 'failed')
+        self.assertIn('2.csv', result['error'])
+        self.assertIsNone(get_pending_job(self.survey2))
+
+    def test_claim_job(self):
+        first = jobs.submit(self.survey, self.user, '1.csv', {})
+        second = self.queue(self.survey, '1.csv')
+        other = jobs.submit(self.survey2, self.user, '2.csv', {})
+        self.assertEqual(claim_job(), first)
+        # Jobs of a survey are run one at a time
+        self.assertEqual(claim_job(), other)
+        self.assertIsNone(claim_job())
+        finish_job(first)
+        self.assertEqual(claim_job(), second)
+        self.assertEqual(get_pending_job(self.survey), second)
+
+    def test_recover_jobs(self):
+        dead = jobs.submit(self.survey, self.user, '1.csv', {})
+        queued = self.queue(self.survey, '1.csv')
+        self.assertEqual(claim_job(), dead)
+        self.assertEqual(recover_jobs(60), 0)
+        self.assertIsNone(claim_job())
+
+        # The worker running the job was killed, so its progress stopped
+        Job.query.filter_by(id=dead.id).update({'UpdatedOn': datetime.now() - timedelta(seconds=120)})
+        db.session.commit()
+        self.assertEqual(recover_jobs(60), 1)
+        result = get_job(dead.id).as_dict()
+        self.assertEqual(result['state'], 'failed')
+        self.assertEqual(result['error'], 'the job was interrupted')
+        self.assertEqual(claim_job(), queued)
+
+    def test_claim_running_survey(self):
+        queued = jobs.submit(self.survey, self.user, '1.csv', {})
+        # Another process starts a job of the survey between the lookup of
+        # the queued job and the update that claims it
+        running = Job(SurveyId=self.survey.id, Filename='1.csv', State='running', CreatedOn=datetime.now(), UpdatedOn=datetime.now())
+        first = Query.first
+        def first_then_start(query):
+            result = first(query)
+            if isinstance(result, Job) and result.State == 'queued':
+                db.session.add(running)
+                db.session.flush()
+            return result
+        with mock.patch.object(Query, 'first', first_then_start):
+            self.assertIsNone(claim_job())
+        self.assertEqual(get_job(queued.id).State, 'queued')
+
+    def test_get_job(self):
+        with self.assertRaises(error.API):
+            get_job(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+import unittest
+import tempfile
+import sqlite3
+import shutil
+import database
+import error
+import pool
+import os
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(f'{self.dir}/data')
+        shutil.copy('test/table.db', f'{self.dir}/data/1.db')
+        shutil.copy('test/table.db', f'{self.dir}/data/2.db')
+        os.chdir(self.dir)
+        self.pool = pool.Pool(pool.connect_survey, 2, 60)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_reuse(self):
+        conn = self.pool.acquire(1, 'v1')
+        self.pool.release(1, 'v1', conn)
+        self.assertIs(self.pool.acquire(1, 'v1'), conn)
+        self.assertIsNot(self.pool.acquire(1, 'v1'), conn)
+        self.assertEqual(self.pool.stats(), {'idle': 0, 'hits': 1, 'misses': 2})
+
+    def test_stale_version(self):
+        conn = self.pool.acquire(1, 'v1')
+        self.pool.release(1, 'v1', conn)
+        self.assertIsNot(self.pool.acquire(1, 'v2'), conn)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+    def test_evict(self):
+        conns = [self.pool.acquire(k, 'v') for k in [1, 1, 2]]
+        for k, c in zip([1, 1, 2], conns):
+            self.pool.release(k, 'v', c)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        self.assertIs(self.pool.acquire(2, 'v'), conns[2])
+
+        self.pool.idle = 0
+        self.pool.evict()
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_invalidate(self):
+        conn = self.pool.acquire(1, 'v')
+        other = self.pool.acquire(2, 'v')
+        self.pool.release(1, 'v', conn)
+        self.pool.release(2, 'v', other)
+        self.pool.invalidate(1)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        self.assertIs(self.pool.acquire(2, 'v'), other)
+
+    def test_read_survey(self):
+        survey = SimpleNamespace(id=1)
+        version = database.get_data_version(survey)
+        with database.read_survey(survey, version) as conn:
+            # The data is replaced while the connection is borrowed
+            os.utime('data/1.db', ns=(0, 0))
+        self.assertNotEqual(database.get_data_version(survey), version)
+        self.assertIs(pool.SURVEYS.acquire(1, version), conn)
+        pool.SURVEYS.invalidate(1)
+        conn.close()
+
+    def test_read_survey_missing(self):
+        survey = SimpleNamespace(id=3)
+        with self.assertRaises(error.API):
+            with database.read_survey(survey):
+                pass
+        self.assertFalse(os.path.exists('data/3.db'))
+
+    def test_read_only(self):
+        conn = pool.connect_survey(1)
+        self.assertGreater(conn.execute('SELECT COUNT(*) FROM data').fetchone()[0], 0)
+        self.assertEqual(conn.execute('PRAGMA query_only').fetchone()[0], 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute('DELETE FROM data')
+        conn.close()
+        with self.assertRaises(sqlite3.OperationalError):
+            pool.connect_survey(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+import unittest
+import tempfile
+import shutil
+from globals import app
+import database
+import main
+import os
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(f'{self.dir}/data')
+        shutil.copy('test/table.db', f'{self.dir}/data/1.db')
+        os.chdir(self.dir)
+        self.survey = SimpleNamespace(id=1)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_get_survey_schema(self):
+        schema = database.get_survey_schema(self.survey)
+        conn = database.open_survey(self.survey)
+        self.assertEqual(schema.types, database.get_types(conn))
+        self.assertEqual(schema.columns, database.get_columns(conn))
+        self.assertIs(database.get_survey_schema(self.survey), schema)
+
+        # A new version of the data has a new schema
+        conn.execute('ALTER TABLE data ADD COLUMN "New" TEXT')
+        conn.commit()
+        conn.close()
+        os.utime('data/1.db', ns=(0, 0))
+        changed = database.get_survey_schema(self.survey)
+        self.assertIsNot(changed, schema)
+        self.assertEqual(changed.columns[-1], 'New')
+
+    def test_no_data(self):
+        os.remove('data/1.db')
+        schema = database.get_survey_schema(self.survey)
+        self.assertEqual(schema.types, {})
+        self.assertEqual(list(schema.columns), [])
+        self.assertFalse(os.path.exists('data/1.db'))
+
+    def test_no_data_endpoints(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        database.db.create_all()
+        user = database.User(CasLogin='admin', Pesel='9999999999', Role='s', FetchData=False)
+        database.db.session.add_all([user, database.Survey(id=2, Name='Ankieta testowa', QuestionCount=0)])
+        database.db.session.commit()
+        database.db.session.add(database.SurveyPermission(SurveyId=2, UserId=user.id, Type='o'))
+        database.db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'admin'
+        try:
+            self.assertEqual(client.get('/api/data/2/types').json, {})
+            self.assertEqual(client.get('/api/data/2/questions').json, {'questions': []})
+            result = client.post('/api/data/2', json={'get': [['A']], 'as': ['count'], 'if': []})
+            self.assertEqual(result.json, {'error': 'could not obtain survey data: no data'})
+        finally:
+            database.db.session.remove()
+            database.db.drop_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
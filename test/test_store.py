@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import pandas
+import numpy
+import json
+import os
+import database
+import store
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(f'{self.dir}/data')
+        shutil.copy('test/table.db', f'{self.dir}/data/1.db')
+        os.chdir(self.dir)
+        self.survey = SimpleNamespace(id=1)
+        self.conn = database.open_survey(self.survey)
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_frame(self):
+        store.build(self.survey)
+        data = store.load(database.get_data_version(self.survey))
+        columns = ['Name', 'Price', 'Age Rating', 'User Rating Count']
+        sql = 'SELECT "Name", "Price", "Age Rating", "User Rating Count" FROM data'
+        expected = pandas.read_sql_query(sql, self.conn).convert_dtypes()
+        pandas.testing.assert_frame_equal(data.frame(columns), expected)
+
+        rowids = [r for r, in self.conn.execute('SELECT rowid FROM data WHERE "Price" = 0')]
+        expected = pandas.read_sql_query(f'{sql} WHERE "Price" = 0', self.conn).convert_dtypes()
+        pandas.testing.assert_frame_equal(data.frame(columns, rowids), expected)
+
+    def test_stale(self):
+        store.build(self.survey)
+        self.conn.execute('DELETE FROM data WHERE "Price" = 0')
+        self.conn.commit()
+        os.utime('data/1.db', ns=(0, 0))
+        self.assertIsNone(store.load(database.get_data_version(self.survey)))
+
+    def test_batches(self):
+        # A REAL column with text in the last row can't be stored
+        self.conn.execute('ALTER TABLE data ADD COLUMN "Mixed" REAL')
+        self.conn.execute('UPDATE data SET "Mixed" = 1.5')
+        self.conn.execute("UPDATE data SET \"Mixed\" = 'x' WHERE rowid = (SELECT MAX(rowid) FROM data)")
+        self.conn.commit()
+
+        def build(rows):
+            batch, store.BATCH_ROWS = store.BATCH_ROWS, rows
+            try:
+                store.build(self.survey)
+            finally:
+                store.BATCH_ROWS = batch
+            files = {}
+            for name in sorted(os.listdir(store.path(1))):
+                if name.endswith('.npy'):
+                    files[name] = numpy.load(f'{store.path(1)}/{name}')
+            with open(f'{store.path(1)}/manifest.json') as file:
+                return json.load(file), files
+
+        manifest, files = build(7)
+        expected_manifest, expected_files = build(10**9)
+        self.assertEqual(manifest, expected_manifest)
+        self.assertNotIn('Mixed', manifest['columns'])
+        self.assertEqual(sorted(files), sorted(expected_files))
+        for name, array in expected_files.items():
+            numpy.testing.assert_array_equal(files[name], array)
@@ -1,5 +1,7 @@
 import unittest
+import pandas
 import sqlite3
+import database
 import table
 import error
 
@@ -276,3 +278,185 @@ class TestCase(unittest.TestCase):
         }
         with self.assertRaises(error.API):
             _ = table.create(query, self.conn)
+
+    def test_apply_filter(self):
+        series = pandas.Series([1, None, 3, 4], dtype='Int64')
+        result = table.apply_filter(series, table.filter_in(1, 4))
+        self.assertEqual(result.tolist(), [1, pandas.NA, pandas.NA, 4])
+        result = table.apply_filter(series, table.filter_ni(1, 4))
+        self.assertEqual(result.tolist(), [pandas.NA, pandas.NA, 3, pandas.NA])
+        self.assertEqual(result.dtype, series.dtype)
+
+    def test_grouping_sets(self):
+        query = {
+            "get": [["Age Rating"]],
+            "as": ["rows"],
+            "by": ["Age Rating", "*", "*Total"],
+        }
+        expected_result = {
+            'index': [4, 9, 12, 17, '*', 'Total'],
+            'rows Age Rating': [4467, 1472, 1333, 289, 7561, 7561]
+        }
+        result = table.create(query, self.conn)
+        self.assertEqual(result, expected_result)
+
+    def test_pushable(self):
+        types = database.get_types(self.conn)
+        query = {
+            "get": [["Age Rating", "Languages"]],
+            "as": ["share", "mean"],
+            "by": ["Primary Genre", "*Total"],
+            "if": [["Price", ">", 0]],
+        }
+        table.typecheck(query, types)
+        self.assertTrue(table.pushable(query, types))
+        query['if'].append([0, '!=', 4])
+        self.assertFalse(table.pushable(query, types))
+        query = {
+            "get": [["Price"]],
+            "as": ["mean"],
+        }
+        table.typecheck(query, types)
+        self.assertFalse(table.pushable(query, types))
+
+    def test_aggregate_sql(self):
+        types = database.get_types(self.conn)
+        query = {
+            "get": [["Age Rating", "Primary Genre", "Languages", "Languages", "Languages", "Languages"]],
+            "as": ["share", "share", "mean", "sum", "max", "count"],
+            "by": ["Age Rating", "Primary Genre", "*Total", "*"],
+            "except": [["Price", ">", 3]],
+        }
+        table.typecheck(query, types)
+        expected_result = table.reorder(table.aggregate(query, table.columns(query, types, self.conn)))
+        result = table.aggregate_sql(query, types, self.conn)
+        self.assertEqual(result, expected_result)
+
+    def test_cache(self):
+        query = {
+            "get": [["Age Rating"]],
+            "as": ["share"],
+            "if": [["Price", ">", 0], ["Age Rating", "!=", 4]],
+        }
+        same_query = {
+            "get": [["Age Rating"]],
+            "as": ["share"],
+            "by": ["*"],
+            "if": [["Age Rating", "!=", 4], ["Price", ">", 0]],
+        }
+        table.CACHE.invalidate()
+        result = table.create(query, self.conn, ('test', 1))
+        hits = table.CACHE.stats()['hits']
+        self.assertIs(table.create(same_query, self.conn, ('test', 1)), result)
+        self.assertEqual(table.CACHE.stats()['hits'], hits + 1)
+        self.assertIsNot(table.create(same_query, self.conn, ('test', 2)), result)
+
+    def test_create_many(self):
+        queries = [
+            {"get": [["Price"]], "as": ["mean"], "by": ["Age Rating"]},
+            {"get": [["Age Rating"]], "as": ["share"]},
+            {"get": [["Price"]], "as": ["unknown"]},
+            {"get": [["Name"]], "as": ["count"], "by": ["Age Rating"]},
+        ]
+        expected_results = [table.create(dict(q), self.conn) for q in [queries[0], queries[1], queries[3]]]
+        results = table.create_many(queries, self.conn)
+        self.assertEqual(results[0], expected_results[0])
+        self.assertEqual(results[1], expected_results[1])
+        self.assertIsInstance(results[2], error.API)
+        self.assertEqual(results[3], expected_results[2])
+
+    def test_profile(self):
+        queries = [
+            {"get": [["Price"]], "as": ["mean"], "by": ["Age Rating"], "if": [["Price", ">", 0]]},
+            {"get": [["Age Rating"]], "as": ["share"]},
+        ]
+        table.CACHE.invalidate()
+        expected = table.create_many(queries, self.conn, ('test', 1))
+        profile = table.Profile()
+        results = table.create_many(queries, self.conn, ('test', 1), profile)
+        self.assertEqual(results, expected)
+        self.assertEqual(profile.cached, 2)
+        self.assertNotIn('profile', results[0])
+
+        profile = table.Profile()
+        result = table.create(queries[0], self.conn, None, profile)
+        self.assertEqual(result, expected[0])
+        profile = profile.as_dict()
+        for name in ['schema', 'sql', 'groupby', 'reorder']:
+            self.assertIn(name, profile['stages'])
+        self.assertGreater(profile['rowsRead'], 0)
+        self.assertGreater(profile['bytes'], 0)
+        self.assertLessEqual(profile['rowsFiltered'], profile['rowsRead'])
+        self.assertTrue(any('Price' in sql for sql in profile['sql']))
+        self.assertEqual(profile['cached'], 0)
+
+        profile = table.Profile(detailed=False)
+        table.create(queries[0], self.conn, None, profile)
+        profile = profile.as_dict()
+        self.assertIn('groupby', profile['stages'])
+        self.assertGreater(profile['rowsRead'], 0)
+        self.assertNotIn('bytes', profile)
+        self.assertNotIn('rowsFiltered', profile)
+
+    def test_sql_where(self):
+        types = database.get_types(self.conn)
+        where = table.get_sql_where({"if": [["Name", "=", "a"], ["Price", "in", 1, 2]]}, types)
+        other = table.get_sql_where({"if": [["Name", "=", "b"], ["Price", "in", 3, 4]]}, types)
+        self.assertEqual(where[0], other[0])
+        self.assertEqual(where[1], ("a", 1, 2))
+
+        # Values with quotes are bound, not pasted into the SQL
+        query = {
+            "get": [["Price"]],
+            "as": ["count"],
+            "if": [["Name", "=", "\"100 Years' War\""]],
+        }
+        self.assertEqual(table.create(query, self.conn)['count Price'], [1])
+        query["if"][0][2] = 'He said "hi"'
+        self.assertEqual(table.create(query, self.conn)['count Price'], [])
+
+    def test_tobasetypes(self):
+        nan = float('nan')
+        cases = [
+            (pandas.Series([1.0, 2.0]), [1, 2]),
+            (pandas.Series([1.0, 2.5]), [1.0, 2.5]),
+            (pandas.Series([1.0, nan]), [1.0, 0.0]),
+            (pandas.Series([nan, nan]), [0, 0]),
+            (pandas.Series([1e20, 2.5]), [10**20, 2.5]),
+            (pandas.Series([1.5, None], dtype='Float64'), [1.5, 0.0]),
+            (pandas.Series([1, 2], dtype='Int64'), [1, 2]),
+            (pandas.Series(['a', None], dtype='string'), ['a', pandas.NA]),
+            (pandas.Series([{4: 1}, 2.0, nan, 'a'], dtype=object), [{4: 1}, 2, 0, 'a']),
+            (pandas.Series([1, None], dtype=object), [1.0, 0.0]),
+        ]
+        for series, expected in cases:
+            result = table.tobasetypes(series)
+            self.assertEqual(list(map(type, result)), list(map(type, expected)))
+            self.assertEqual(repr(result), repr(expected))
+
+    def test_aggregate_groups(self):
+        data = table.select({'Primary Genre', 'Age Rating', 'Languages', 'Developer'}, table.get_sql_where({}, {}), self.conn)
+        data = data.rename(columns={'Primary Genre': 'group Primary Genre'})
+        columns = {
+            'Age Rating': [table.share],
+            'Languages': [table.mode],
+            'Developer': [table.share],
+        }
+        for key in ['group Primary Genre', [True]*len(data.index)]:
+            grouped = data.groupby(key)
+            expected = table.reorder(grouped.aggregate(columns))
+            result = table.reorder(table.aggregate_groups(grouped, data, columns))
+            self.assertEqual(result, expected)
+            for name in columns:
+                for a, b in zip(result[name], expected[name]):
+                    self.assertEqual(list(a.items()) if type(a) is dict else a, list(b.items()) if type(b) is dict else b)
+
+    def test_join_many(self):
+        query = {
+            "get": [["Joined"]],
+            "as": ["share"],
+            "join": [{"name": "Joined", "of": ["Age Rating"]*30}],
+        }
+        single = table.create({"get": [["Age Rating"]], "as": ["share"]}, self.conn)
+        result = table.create(query, self.conn)
+        self.assertEqual(result['share Joined'], [{k: 30*v for k, v in single['share Age Rating'][0].items()}])